@@ -0,0 +1,308 @@
+import itertools
+import json
+import multiprocessing
+import platform
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Union
+
+from graph_generator import GraphGenerator
+
+# Notice: The peak RSS is only measured where the resource module exists (not on Windows)
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def get_peak_rss_mb() -> Optional[float]:
+    """
+    :return: The peak resident set size of the current process in MB (None if it can't be measured).
+    """
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Notice: ru_maxrss is in bytes on macOS, and in kilobytes on Linux
+    return peak_rss / (1 << 20) if sys.platform == "darwin" else peak_rss / (1 << 10)
+
+
+##############
+# Benchmarks #
+##############
+class GraphGeneratorBenchmark:
+    def __init__(self, tree_mode: bool = True, growth_mode: str = "sequential", seed: int = 0):
+        self.tree_mode = tree_mode
+        self.growth_mode = growth_mode
+        self.seed = seed
+
+    def run(self, num_of_nodes_list: List[int]) -> List[dict]:
+        """
+        Time generate_random_3d_pipe_graph for each number of nodes.
+        Linear scaling shows as a constant time per node along the sweep.
+        """
+        results = []
+        for num_of_nodes in num_of_nodes_list:
+            gg = GraphGenerator(rng=random.Random(self.seed))
+            start_time = time.perf_counter()
+            pipe_graph = gg.generate_random_3d_pipe_graph(
+                num_of_nodes=num_of_nodes,
+                tree_mode=self.tree_mode,
+                growth_mode=self.growth_mode
+            )
+            elapsed_time = time.perf_counter() - start_time
+
+            result = {
+                "growth_mode": self.growth_mode,
+                "num_of_nodes": num_of_nodes,
+                "generated_nodes": len(pipe_graph),
+                "seconds": elapsed_time,
+                "microseconds_per_node": 1e6 * elapsed_time / max(len(pipe_graph), 1)
+            }
+            results.append(result)
+            print(
+                f"{result['growth_mode']:>10} | "
+                f"nodes: {result['num_of_nodes']:>9} | "
+                f"generated: {result['generated_nodes']:>9} | "
+                f"time: {result['seconds']:>9.3f}s | "
+                f"per node: {result['microseconds_per_node']:>7.2f}us"
+            )
+        return results
+
+
+def get_benchmark_case_key(case: dict) -> str:
+    return "|".join(f"{name}={value}" for name, value in case.items())
+
+
+def run_benchmark_case(case: dict, mesh_dir: str, mesh_scale: Union[int, float], num_of_repeats: int) -> dict:
+    """
+    Run a single benchmark case (in a fresh process, so the peak RSS is the peak of the case).
+    The input graph is generated (and the kit is loaded) before the timing, and the best time of the repeats is kept.
+    """
+    from mesh_builder import MeshBuilder
+
+    gg = GraphGenerator(rng=random.Random(0))
+    pipe_graph = None
+    mb = None
+    if case["entry_point"] != "generate_random_3d_pipe_graph":
+        pipe_graph = gg.generate_random_3d_pipe_graph(
+            num_of_nodes=case["num_of_nodes"],
+            tree_mode=case["tree_mode"],
+            growth_mode=case.get("growth_mode", "sequential")
+        )
+        mb = MeshBuilder(mesh_dir=mesh_dir, mesh_scale=mesh_scale, mesh_apply_scale=case["mesh_apply_scale"])
+    start_rss_mb = get_peak_rss_mb()
+
+    best_seconds = float("inf")
+    count_name, count = "nodes", 0
+    for repeat_idx in range(num_of_repeats):
+        start_time = time.perf_counter()
+        if case["entry_point"] == "generate_random_3d_pipe_graph":
+            gg = GraphGenerator(rng=random.Random(repeat_idx))
+            output = gg.generate_random_3d_pipe_graph(
+                num_of_nodes=case["num_of_nodes"],
+                tree_mode=case["tree_mode"],
+                growth_mode=case["growth_mode"]
+            )
+            count_name, count = "nodes", len(output)
+        elif case["entry_point"] == "build_mesh":
+            output = mb.build_mesh(graph=pipe_graph, output_only=True)
+            count_name, count = "vertices", len(output.vertices)
+        elif case["entry_point"] == "build_pcd":
+            output = mb.build_pcd(
+                input_object=pipe_graph,
+                use_sample_method=case["use_sample_method"],
+                points_to_sample=1.0,
+                output_only=True,
+                seed=repeat_idx
+            )
+            count_name, count = "points", len(output)
+        else:
+            raise ValueError(f"Invalid benchmark entry point: {case['entry_point']}")
+        best_seconds = min(best_seconds, time.perf_counter() - start_time)
+        del output
+
+    peak_rss_mb = get_peak_rss_mb()
+    return {
+        "key": get_benchmark_case_key(case=case),
+        **case,
+        "seconds": best_seconds,
+        "peak_rss_mb": peak_rss_mb,
+        "case_rss_mb": peak_rss_mb - start_rss_mb if peak_rss_mb is not None else None,
+        "throughput": {f"{count_name}_per_second": count / best_seconds if best_seconds > 0 else None}
+    }
+
+
+class BenchmarkSuite:
+    def __init__(self,
+                 mesh_dir: str = "connection_types",
+                 mesh_scale: Union[int, float] = 66,
+                 num_of_repeats: int = 3,
+                 regression_threshold: float = 0.2,
+                 min_regression_seconds: float = 0.005):
+        """
+        A scaling benchmark of the public entry points (graph generation, mesh assembly and point cloud sampling).
+        Each case runs in a fresh process, and its wall time, peak RSS and throughput are compared to a baseline.
+        :param mesh_dir: The kit directory.
+        :param mesh_scale: The kit mesh scale.
+        :param num_of_repeats: The number of timed runs of each case (the best time is kept).
+        :param regression_threshold: The relative increase of the time (or of the peak RSS) over the baseline above
+        which a case is a regression (e.g. 0.2 for 20%).
+        :param min_regression_seconds: The time increase below which a case is never a regression (timer noise).
+        """
+        self.mesh_dir = mesh_dir
+        self.mesh_scale = mesh_scale
+        self.num_of_repeats = num_of_repeats
+        self.regression_threshold = regression_threshold
+        self.min_regression_seconds = min_regression_seconds
+
+    @staticmethod
+    def get_cases(graph_num_of_nodes_list: List[int],
+                  mesh_num_of_nodes_list: List[int],
+                  tree_modes: List[bool],
+                  growth_modes: List[str],
+                  mesh_apply_scales: List[float],
+                  use_sample_methods: List[bool]) -> List[dict]:
+        """
+        The sweep of each entry point.
+        Notice: The meshes grow by ~1,200 vertices per node, so the mesh sweeps use a separate list of node counts.
+        """
+        cases = []
+        for num_of_nodes, tree_mode, growth_mode in itertools.product(graph_num_of_nodes_list, tree_modes,
+                                                                      growth_modes):
+            cases.append({"entry_point": "generate_random_3d_pipe_graph", "num_of_nodes": num_of_nodes,
+                          "tree_mode": tree_mode, "growth_mode": growth_mode})
+        for num_of_nodes, tree_mode, mesh_apply_scale in itertools.product(mesh_num_of_nodes_list, tree_modes,
+                                                                           mesh_apply_scales):
+            cases.append({"entry_point": "build_mesh", "num_of_nodes": num_of_nodes, "tree_mode": tree_mode,
+                          "mesh_apply_scale": mesh_apply_scale})
+        for num_of_nodes, tree_mode, use_sample_method in itertools.product(mesh_num_of_nodes_list, tree_modes,
+                                                                            use_sample_methods):
+            cases.append({"entry_point": "build_pcd", "num_of_nodes": num_of_nodes, "tree_mode": tree_mode,
+                          "mesh_apply_scale": 1.0, "use_sample_method": use_sample_method})
+        return cases
+
+    def run(self, cases: List[dict]) -> List[dict]:
+        # Notice: The spawn context gives each case a fresh interpreter (a forked process inherits the parent RSS)
+        mp_context = multiprocessing.get_context("spawn")
+        results = []
+        for case in cases:
+            with ProcessPoolExecutor(max_workers=1, mp_context=mp_context) as executor:
+                result = executor.submit(run_benchmark_case, case, self.mesh_dir, self.mesh_scale,
+                                         self.num_of_repeats).result()
+            results.append(result)
+            peak_rss = f"{result['peak_rss_mb']:>8.1f}MB" if result["peak_rss_mb"] is not None else f"{'-':>10}"
+            throughput = " ".join(f"{name}: {value:.0f}" for name, value in result["throughput"].items())
+            print(f"{result['key']:<95} | time: {result['seconds']:>8.3f}s | peak RSS: {peak_rss} | {throughput}")
+        return results
+
+    def compare(self, results: List[dict], baseline: dict) -> List[str]:
+        """
+        :param baseline: The baseline results (see save_baseline).
+        :return: The regressions (a message per regressed case and measure).
+        """
+        regressions = []
+        baseline_results = baseline["results"]
+        for result in results:
+            baseline_result = baseline_results.get(result["key"])
+            if baseline_result is None:
+                continue
+
+            seconds_limit = baseline_result["seconds"] * (1 + self.regression_threshold)
+            if result["seconds"] > seconds_limit and \
+                    result["seconds"] - baseline_result["seconds"] > self.min_regression_seconds:
+                regressions.append(
+                    f"{result['key']}: time {result['seconds']:.3f}s > baseline {baseline_result['seconds']:.3f}s"
+                )
+
+            if result["peak_rss_mb"] is not None and baseline_result["peak_rss_mb"] is not None and \
+                    result["peak_rss_mb"] > baseline_result["peak_rss_mb"] * (1 + self.regression_threshold):
+                regressions.append(
+                    f"{result['key']}: peak RSS {result['peak_rss_mb']:.1f}MB > "
+                    f"baseline {baseline_result['peak_rss_mb']:.1f}MB"
+                )
+        return regressions
+
+    @staticmethod
+    def save_baseline(filepath: str, results: List[dict]):
+        baseline = {
+            "platform": platform.platform(),
+            "python_version": platform.python_version(),
+            "results": {result["key"]: result for result in results}
+        }
+        with open(filepath, "w") as fp:
+            json.dump(obj=baseline, fp=fp, indent=4)
+
+    @staticmethod
+    def load_baseline(filepath: str) -> dict:
+        with open(filepath, "r") as fp:
+            return json.load(fp=fp)
+
+
+##################
+# Core Functions #
+##################
+def scaling_benchmark():
+    # Benchmark Parameters
+    num_of_nodes_list = [100, 1000, 10000, 100000, 1000000]
+    tree_mode = True
+    growth_modes = ["sequential", "layered"]
+
+    for growth_mode in growth_modes:
+        GraphGeneratorBenchmark(tree_mode=tree_mode, growth_mode=growth_mode).run(num_of_nodes_list=num_of_nodes_list)
+
+
+def benchmark_suite() -> int:
+    # Sweep Parameters
+    graph_num_of_nodes_list = [10, 100, 1000, 10000, 100000]
+    mesh_num_of_nodes_list = [10, 100, 1000, 10000]
+    tree_modes = [True, False]
+    growth_modes = ["sequential", "layered"]
+    mesh_apply_scales = [1.0, 0.5]
+    use_sample_methods = [True, False]
+
+    # Baseline Parameters
+    baseline_filepath = "benchmarks_baseline.json"
+    results_filepath = "benchmarks_results.json"
+    update_baseline = False  # True to save the results as the new baseline
+    regression_threshold = 0.2
+
+    suite = BenchmarkSuite(regression_threshold=regression_threshold)
+    cases = suite.get_cases(
+        graph_num_of_nodes_list=graph_num_of_nodes_list,
+        mesh_num_of_nodes_list=mesh_num_of_nodes_list,
+        tree_modes=tree_modes,
+        growth_modes=growth_modes,
+        mesh_apply_scales=mesh_apply_scales,
+        use_sample_methods=use_sample_methods
+    )
+    results = suite.run(cases=cases)
+    suite.save_baseline(filepath=results_filepath, results=results)
+
+    if update_baseline is True:
+        suite.save_baseline(filepath=baseline_filepath, results=results)
+        print(f"Saved the baseline: {baseline_filepath}")
+        return 0
+
+    try:
+        baseline = suite.load_baseline(filepath=baseline_filepath)
+    except FileNotFoundError:
+        print(f"No baseline to compare to: {baseline_filepath} (set update_baseline to save one)")
+        return 0
+
+    regressions = suite.compare(results=results, baseline=baseline)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    print(f"{len(regressions)} regressions (threshold: {100 * regression_threshold:.0f}%)")
+    return 1 if regressions else 0
+
+
+def main():
+    exit_code = benchmark_suite()
+    # scaling_benchmark()
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+import io
+import json
+import os
+import re
+import tarfile
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+ARCHIVE_SHARD_SUFFIX = ".tar"
+ARCHIVE_INDEX_SUFFIX = ".index.jsonl"
+
+
+def get_archive_shard_filename(prefix: str, shard_number: int) -> str:
+    return f"{prefix}-{shard_number:06d}{ARCHIVE_SHARD_SUFFIX}"
+
+
+def get_archive_index_filename(prefix: str, shard_number: int) -> str:
+    return f"{prefix}-{shard_number:06d}{ARCHIVE_INDEX_SUFFIX}"
+
+
+class ArchiveWriter:
+    def __init__(self, archive_dir: str, prefix: str = "shard", max_shard_size: int = 1 << 30):
+        """
+        Pack samples (a few named files each) into tar shard files of about a fixed size, instead of many small files.
+        Each shard has an index of the data offset and size of each member file, so any sample can be read with a
+        single seek, and the shards can still be read by any tar tool.
+        A shard is written to a temporary file and renamed when it is complete, and its index is written last,
+        so a shard with an index is always complete. The temporary files left by killed writers of the prefix are
+        removed when the writer is opened.
+        :param archive_dir: The directory of the shard files.
+        :param prefix: The shard filename prefix (the shards are numbered after the existing shards of the prefix).
+        :param max_shard_size: The shard size (in bytes) after which a new shard is started (samples are never split).
+        """
+        self.archive_dir = archive_dir
+        self.prefix = prefix
+        self.max_shard_size = max_shard_size
+        os.makedirs(name=archive_dir, exist_ok=True)
+
+        # Remove the temporary shard and index files of killed writers
+        shard_pattern = f"{re.escape(prefix)}-\\d{{6}}"
+        tmp_pattern = re.compile(f"^(\\.tmp-\\d+-{shard_pattern}{re.escape(ARCHIVE_SHARD_SUFFIX)}|"
+                                 f"{shard_pattern}{re.escape(ARCHIVE_INDEX_SUFFIX)}\\.\\d+\\.tmp)$")
+        for filename in os.listdir(archive_dir):
+            if tmp_pattern.match(filename) is not None:
+                os.remove(os.path.join(archive_dir, filename))
+
+        existing_shard_numbers = [shard_number for shard_number, _ in find_archive_shards(archive_dir, prefix)]
+        self.shard_number = max(existing_shard_numbers) + 1 if existing_shard_numbers else 0
+        self.shard_fp = None
+        self.shard_tar = None
+        self.shard_tmp_filepath = None
+        self.shard_index = []
+
+    def open_shard(self):
+        shard_filename = get_archive_shard_filename(prefix=self.prefix, shard_number=self.shard_number)
+        self.shard_tmp_filepath = os.path.join(self.archive_dir, f".tmp-{os.getpid()}-{shard_filename}")
+        self.shard_fp = open(self.shard_tmp_filepath, "wb")
+        self.shard_tar = tarfile.open(fileobj=self.shard_fp, mode="w", format=tarfile.GNU_FORMAT)
+        self.shard_index = []
+
+    def close_shard(self):
+        if self.shard_tar is None:
+            return
+        self.shard_tar.close()
+        self.shard_fp.close()
+        shard_filename = get_archive_shard_filename(prefix=self.prefix, shard_number=self.shard_number)
+        os.replace(self.shard_tmp_filepath, os.path.join(self.archive_dir, shard_filename))
+
+        index_filepath = os.path.join(
+            self.archive_dir,
+            get_archive_index_filename(prefix=self.prefix, shard_number=self.shard_number)
+        )
+        tmp_index_filepath = f"{index_filepath}.{os.getpid()}.tmp"
+        with open(tmp_index_filepath, "w") as fp:
+            fp.writelines(json.dumps(entry, separators=(",", ":")) + "\n" for entry in self.shard_index)
+        os.replace(tmp_index_filepath, index_filepath)
+
+        self.shard_number += 1
+        self.shard_fp = None
+        self.shard_tar = None
+        self.shard_tmp_filepath = None
+        self.shard_index = []
+
+    def write(self, key: str, members: Dict[str, bytes]) -> str:
+        """
+        :param key: The sample key.
+        :param members: The member filename -> data of the sample files.
+        :return: The filename of the shard of the sample.
+        """
+        sample_size = sum(len(data) for data in members.values())
+        if self.shard_tar is not None and self.shard_tar.offset + sample_size > self.max_shard_size:
+            self.close_shard()
+        if self.shard_tar is None:
+            self.open_shard()
+
+        member_locations = {}
+        for name, data in members.items():
+            tarinfo = tarfile.TarInfo(name=name)
+            tarinfo.size = len(data)
+            tarinfo.mode = 0o644
+            self.shard_tar.addfile(tarinfo=tarinfo, fileobj=io.BytesIO(data))
+            # Notice: The member data is padded to the tar block size, and ends at the current tar offset
+            padded_size = -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            member_locations[name] = [self.shard_tar.offset - padded_size, len(data)]
+        self.shard_index.append({"key": key, "members": member_locations})
+        return get_archive_shard_filename(prefix=self.prefix, shard_number=self.shard_number)
+
+    def close(self):
+        self.close_shard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def find_archive_shards(archive_dir: str, prefix: Optional[str] = None) -> List[Tuple[int, str]]:
+    """
+    :return: The (shard number, shard path prefix) of the complete shards (the shards with an index), in order.
+    """
+    prefix_pattern = re.escape(prefix) if prefix is not None else ".+"
+    index_pattern = re.compile(f"^({prefix_pattern})-(\\d{{6}}){re.escape(ARCHIVE_INDEX_SUFFIX)}$")
+    shards = []
+    for filename in sorted(os.listdir(archive_dir)) if os.path.isdir(archive_dir) else []:
+        match = index_pattern.match(filename)
+        if match is not None:
+            shards.append((int(match.group(2)), os.path.join(archive_dir, f"{match.group(1)}-{match.group(2)}")))
+    return shards
+
+
+class ArchiveReader:
+    def __init__(self, archive_dir: str, prefix: Optional[str] = None):
+        """
+        Read the samples of the archive shards, streamed in storage order (large sequential reads) or by key.
+        When a sample key is in more than one shard (e.g. a regenerated sample), the latest shard is used.
+        Notice: The open shard files are shared, so a reader must not be used by several threads at once.
+        :param archive_dir: The directory of the shard files.
+        :param prefix: The shard filename prefix (None for all the shards in the directory).
+        """
+        self.archive_dir = archive_dir
+        self.entries = []
+        self.sample_entries = {}
+        self.member_entries = {}
+        for _, shard_path_prefix in find_archive_shards(archive_dir=archive_dir, prefix=prefix):
+            shard_filepath = f"{shard_path_prefix}{ARCHIVE_SHARD_SUFFIX}"
+            with open(f"{shard_path_prefix}{ARCHIVE_INDEX_SUFFIX}", "r") as fp:
+                for line in fp:
+                    entry = json.loads(line)
+                    entry["shard"] = shard_filepath
+                    self.sample_entries[entry["key"]] = len(self.entries)
+                    for name in entry["members"]:
+                        self.member_entries[name] = len(self.entries)
+                    self.entries.append(entry)
+        self.shard_fps = {}
+
+    def __len__(self) -> int:
+        return len(self.sample_entries)
+
+    def keys(self) -> List[str]:
+        return [entry["key"] for entry_idx, entry in enumerate(self.entries)
+                if self.sample_entries[entry["key"]] == entry_idx]
+
+    def read_data(self, shard_filepath: str, offset: int, size: int) -> bytes:
+        if shard_filepath not in self.shard_fps:
+            self.shard_fps[shard_filepath] = open(shard_filepath, "rb")
+        shard_fp = self.shard_fps[shard_filepath]
+        shard_fp.seek(offset)
+        return shard_fp.read(size)
+
+    def read_entry(self, entry: dict) -> Dict[str, bytes]:
+        return {
+            name: self.read_data(shard_filepath=entry["shard"], offset=offset, size=size)
+            for name, (offset, size) in entry["members"].items()
+        }
+
+    def read(self, key: str) -> Dict[str, bytes]:
+        """
+        :return: The member filename -> data of the sample files.
+        """
+        return self.read_entry(entry=self.entries[self.sample_entries[key]])
+
+    def has_member(self, name: str) -> bool:
+        return name in self.member_entries
+
+    def read_member(self, name: str) -> Optional[bytes]:
+        """
+        :return: The data of a member file (None if it is not in the archive).
+        """
+        if name not in self.member_entries:
+            return None
+        entry = self.entries[self.member_entries[name]]
+        offset, size = entry["members"][name]
+        return self.read_data(shard_filepath=entry["shard"], offset=offset, size=size)
+
+    def __iter__(self) -> Iterator[Tuple[str, Dict[str, bytes]]]:
+        """
+        Stream the (key, members) samples in storage order (shard by shard, each shard read sequentially).
+        """
+        for entry_idx, entry in enumerate(self.entries):
+            if self.sample_entries[entry["key"]] == entry_idx:
+                yield entry["key"], self.read_entry(entry=entry)
+
+    def close(self):
+        for shard_fp in self.shard_fps.values():
+            shard_fp.close()
+        self.shard_fps = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def main():
+    # Archive Parameters
+    archive_dir = "output"
+
+    with ArchiveReader(archive_dir=archive_dir) as reader:
+        for key, members in reader:
+            print(f"{key}: {', '.join(f'{name} ({len(data)} bytes)' for name, data in members.items())}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,56 @@
 import json
 import random
 from collections import deque
-import networkx as nx
+import numpy as np
 import matplotlib.pyplot as plt
-from typing import Tuple, List
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from mpl_toolkits.mplot3d.art3d import Line3DCollection
+from typing import Tuple, List, Optional, Union
+
+# Notice: networkx is optional (only for the graph analysis view of generate_graph_3d)
+try:
+    import networkx as nx
+except ImportError:
+    nx = None
+
+from pipe_graph import PipeGraph, CONNECTION_TYPE_BITS, CONNECTION_TYPE_DELTAS as CONNECTION_TYPE_DELTAS_ARRAY, \
+    POSITION_KEY_OFFSET, connections_to_mask, get_position_keys, lookup_position_keys
+
+
+# Direction tables (connection type -> neighbor position delta / opposite connection type)
+CONNECTION_TYPE_DELTAS = {
+    "x": (1, 0, 0),
+    "-x": (-1, 0, 0),
+    "y": (0, 1, 0),
+    "-y": (0, -1, 0),
+    "z": (0, 0, 1),
+    "-z": (0, 0, -1),
+}
+OPPOSITE_CONNECTION_TYPES = {
+    "x": "-x",
+    "-x": "x",
+    "y": "-y",
+    "-y": "y",
+    "z": "-z",
+    "-z": "z",
+}
+
+# Layered growth tables (connection type index -> bit / bit of the opposite connection type)
+CONNECTION_TYPE_INDEX_BITS = (1 << np.arange(6)).astype(np.uint8)
+OPPOSITE_CONNECTION_TYPE_INDEX_BITS = (1 << (np.arange(6) ^ 1)).astype(np.uint8)
+
+# Notice: The layered growth packs the positions into int64 keys of POSITION_KEY_BITS bits per coordinate.
+# A node coordinate is at most N - 1 in absolute value, and the neighbor probe adds 1, so the offset coordinates
+# range over [POSITION_KEY_OFFSET - N, POSITION_KEY_OFFSET + N], which fits the field only for N < POSITION_KEY_OFFSET
+LAYERED_MAX_NUM_OF_NODES = POSITION_KEY_OFFSET - 1
 
 
 class GraphGenerator:
-    def __init__(self):
+    def __init__(self, rng: Optional[random.Random] = None):
+        # Notice: Use a dedicated random generator (instead of the global one) for reproducible graphs
+        self.rng = rng if rng is not None else random.Random()
+
         # Parameters
         self.available_num_of_connections = [1, 2, 3, 4, 5, 6]
         self.num_of_connections_probabilities = [0.05, 0.5, 0.2, 0.1, 0.10, 0.05]
@@ -25,7 +68,7 @@ class GraphGenerator:
     # Utility functions #
     #####################
     def get_random_min_num_of_connections(self) -> int:
-        min_num_of_connections = random.choices(
+        min_num_of_connections = self.rng.choices(
             population=self.available_num_of_connections,
             weights=self.num_of_connections_probabilities,
             k=1
@@ -33,55 +76,39 @@ class GraphGenerator:
         return min_num_of_connections[0]
 
     def get_opposite_connection_type(self, connection_type: str) -> str:
-        if connection_type not in self.connection_types:
+        opposite_connection_type = OPPOSITE_CONNECTION_TYPES.get(connection_type)
+        if opposite_connection_type is None:
             raise ValueError(f"Invalid connection type: {connection_type}")
-
-        if "-" in connection_type:
-            opposite_connection_type = connection_type[1:]
-        else:
-            opposite_connection_type = "-" + connection_type
         return opposite_connection_type
 
     @staticmethod
     def get_connection_type_node_position(node_position: Tuple[int, int, int],
                                           connection_type: str) -> Tuple[int, int, int]:
-        deltas = {
-            "x": (1, 0, 0),
-            "-x": (-1, 0, 0),
-            "y": (0, 1, 0),
-            "-y": (0, -1, 0),
-            "z": (0, 0, 1),
-            "-z": (0, 0, -1),
-        }
-
-        if connection_type not in deltas:
+        delta = CONNECTION_TYPE_DELTAS.get(connection_type)
+        if delta is None:
             raise ValueError(f"Invalid connection type: {connection_type}")
 
-        dx, dy, dz = deltas[connection_type]
+        dx, dy, dz = delta
         connection_type_node_position = (node_position[0] + dx, node_position[1] + dy, node_position[2] + dz)
         return connection_type_node_position
 
     def get_node_opened_and_closed_connection_lists(self,
                                                     node_position: Tuple[int, int, int],
-                                                    nodes_data: dict,
+                                                    opened_masks: bytearray,
                                                     position_to_node_map: dict) -> Tuple[List[str], List[str]]:
         opened_connection_list = []
         closed_connection_list = []
 
-        for connection_type in self.connection_types:
-            neighbor_node_position = self.get_connection_type_node_position(
-                node_position=node_position,
-                connection_type=connection_type
-            )
-            neighbor_node_idx = position_to_node_map.get(neighbor_node_position, -1)
+        x, y, z = node_position
+        for connection_type, (dx, dy, dz) in CONNECTION_TYPE_DELTAS.items():
+            neighbor_node_idx = position_to_node_map.get((x + dx, y + dy, z + dz), -1)
 
+            # Notice: The connections of a node that are not opened are closed
             if neighbor_node_idx != -1:
-                neighbor_connection_type = self.get_opposite_connection_type(connection_type=connection_type)
-
-                if neighbor_connection_type in nodes_data[neighbor_node_idx]["opened_connection_list"]:
+                neighbor_connection_type = OPPOSITE_CONNECTION_TYPES[connection_type]
+                if opened_masks[neighbor_node_idx] & CONNECTION_TYPE_BITS[neighbor_connection_type]:
                     opened_connection_list.append(connection_type)
-
-                if neighbor_connection_type in nodes_data[neighbor_node_idx]["closed_connection_list"]:
+                else:
                     closed_connection_list.append(connection_type)
 
         return opened_connection_list, closed_connection_list
@@ -98,7 +125,7 @@ class GraphGenerator:
             # Check if an opposite connection and at least one other connection are selectable
             # (Coupler and Elbow connection types are selectable)
             if opposite_connection in selectable_connection and num_of_selectable_connections > 1:
-                selected_option = random.choices(
+                selected_option = self.rng.choices(
                     population=["Coupler", "Elbow"],
                     weights=self.coupler_elbow_probabilities,
                     k=1
@@ -107,18 +134,18 @@ class GraphGenerator:
                     new_connection_types = [opposite_connection]
                 else:  # Elbow
                     selectable_connection.remove(opposite_connection)
-                    new_connection_types = random.sample(population=selectable_connection, k=1)
+                    new_connection_types = self.rng.sample(population=selectable_connection, k=1)
 
             # Either Coupler or Elbow connection is only selectable
             else:
-                new_connection_types = random.sample(population=selectable_connection, k=1)
+                new_connection_types = self.rng.sample(population=selectable_connection, k=1)
 
         # Special case: select between Tee or Three Way Elbow connection types
 
         # Special case: select between Four Way Tee or Four Way Elbow connection types
 
         else:
-            new_connection_types = random.sample(population=selectable_connection, k=num_of_choices_available)
+            new_connection_types = self.rng.sample(population=selectable_connection, k=num_of_choices_available)
 
         return new_connection_types
 
@@ -126,8 +153,11 @@ class GraphGenerator:
                                         min_num_of_connections: int,
                                         opened_connection_list: List[str],
                                         closed_connection_list: List[str]) -> List[str]:
-        selectable_connection = set(self.connection_types) - set(opened_connection_list) - set(closed_connection_list)
-        selectable_connection = list(selectable_connection)
+        # Notice: Keep the connection types order (set order is not reproducible between runs)
+        selectable_connection = [
+            connection_type for connection_type in self.connection_types
+            if connection_type not in opened_connection_list and connection_type not in closed_connection_list
+        ]
 
         num_of_selectable_connections = len(selectable_connection)
         num_of_choices_available = min_num_of_connections - len(opened_connection_list)
@@ -150,7 +180,7 @@ class GraphGenerator:
 
         # Randomly select new connections to reach min number of connections
         else:
-            new_connection_types = random.sample(population=selectable_connection, k=num_of_choices_available)
+            new_connection_types = self.rng.sample(population=selectable_connection, k=num_of_choices_available)
 
         return new_connection_types
 
@@ -159,17 +189,20 @@ class GraphGenerator:
                             opened_connection_list: List[str],
                             closed_connection_list: List[str],
                             position_to_node_map: dict,
-                            nodes_data: dict) -> Tuple[List[str], List[str]]:
+                            opened_masks: bytearray) -> Tuple[List[str], List[str]]:
         # Check if the node has more than one open connection
         if len(opened_connection_list) > 1:
             # Randomly select a connection to keep
-            new_opened_connection_list = random.choices(
+            new_opened_connection_list = self.rng.choices(
                 population=opened_connection_list,
                 k=1
             )
 
             # Move the disabled connections to the closed connections
-            disabled_connection_list = list(set(opened_connection_list) - set(new_opened_connection_list))
+            disabled_connection_list = [
+                connection_type for connection_type in opened_connection_list
+                if connection_type not in new_opened_connection_list
+            ]
             opened_connection_list = new_opened_connection_list
             for connection_type in disabled_connection_list:
                 # Add the connection to the closed connections
@@ -183,8 +216,7 @@ class GraphGenerator:
                 neighbor_node_idx = position_to_node_map.get(neighbor_node_position, -1)
                 if neighbor_node_idx != -1:
                     neighbor_connection_type = self.get_opposite_connection_type(connection_type=connection_type)
-                    nodes_data[neighbor_node_idx]["opened_connection_list"].remove(neighbor_connection_type)
-                    nodes_data[neighbor_node_idx]["closed_connection_list"].append(neighbor_connection_type)
+                    opened_masks[neighbor_node_idx] &= ~CONNECTION_TYPE_BITS[neighbor_connection_type]
                 else:
                     raise ValueError(f"[BUG] Neighbor node index: {neighbor_node_idx} should exists!")
         else:
@@ -195,29 +227,44 @@ class GraphGenerator:
     ######################
     # Building functions #
     ######################
-    def generate_random_3d_nodes_data(self, num_of_nodes: int, tree_mode: bool = False, output_filepath=None) -> dict:
+    def generate_random_3d_pipe_graph(self,
+                                      num_of_nodes: int,
+                                      tree_mode: bool = False,
+                                      growth_mode: str = "sequential") -> PipeGraph:
+        """
+        :param num_of_nodes: The max number of nodes.
+        :param tree_mode: Prohibit cycles.
+        :param growth_mode: "sequential" (one node at a time) or "layered" (one BFS layer at a time, vectorized).
+        """
+        if growth_mode == "layered":
+            return self.generate_random_3d_pipe_graph_layered(num_of_nodes=num_of_nodes, tree_mode=tree_mode)
+        elif growth_mode != "sequential":
+            raise ValueError(f"Invalid growth mode: {growth_mode}")
+
         current_num_of_nodes = 0
-        nodes_data = {}
+        positions = []
+        opened_masks = bytearray()
         position_to_node_map = {}
 
+        # Notice: The frontier keeps the BFS order in a queue and the queued positions in a set (O(1) lookups)
         node_position = (0, 0, 0)
         node_positions_queue = deque()
         node_positions_queue.append(node_position)
+        queued_node_positions = {node_position}
         current_num_of_nodes += 1
 
         for node_idx in range(num_of_nodes):
-            node_idx = str(node_idx)
-
             # Check if there are no more nodes that can be added
             if not node_positions_queue:
                 break
 
             # Pop next node in queue
             node_position = node_positions_queue.popleft()
+            queued_node_positions.discard(node_position)
             min_num_of_connections = self.get_random_min_num_of_connections()
             opened_connection_list, closed_connection_list = self.get_node_opened_and_closed_connection_lists(
                 node_position=node_position,
-                nodes_data=nodes_data,
+                opened_masks=opened_masks,
                 position_to_node_map=position_to_node_map
             )
 
@@ -227,7 +274,7 @@ class GraphGenerator:
                     opened_connection_list=opened_connection_list,
                     closed_connection_list=closed_connection_list,
                     position_to_node_map=position_to_node_map,
-                    nodes_data=nodes_data
+                    opened_masks=opened_masks
                 )
 
             # Set new connections to the node
@@ -239,12 +286,8 @@ class GraphGenerator:
 
             # Add node to graph
             opened_connection_list.extend(new_connection_types)
-            closed_connection_list = list(set(self.connection_types) - set(opened_connection_list))
-            nodes_data[node_idx] = {
-                "position": node_position,
-                "opened_connection_list": opened_connection_list,
-                "closed_connection_list": closed_connection_list
-            }
+            positions.append(node_position)
+            opened_masks.append(connections_to_mask(connections=opened_connection_list))
             position_to_node_map[node_position] = node_idx
 
             # Add new node potions to queue
@@ -256,23 +299,170 @@ class GraphGenerator:
 
                 # Prevent adding the same node position twice
                 conditions = [
-                    position_to_node_map.get(new_node_position, -1) == -1,
-                    new_node_position not in node_positions_queue,
+                    new_node_position not in position_to_node_map,
+                    new_node_position not in queued_node_positions,
                     current_num_of_nodes < num_of_nodes
                 ]
                 if all(conditions):
                     node_positions_queue.append(new_node_position)
+                    queued_node_positions.add(new_node_position)
                     current_num_of_nodes += 1
 
+        return PipeGraph(
+            positions=np.array(positions, dtype=np.int32),
+            opened_masks=np.frombuffer(opened_masks, dtype=np.uint8)
+        )
+
+    def generate_random_3d_pipe_graph_layered(self, num_of_nodes: int, tree_mode: bool = False) -> PipeGraph:
+        """
+        Layer-synchronous growth: the nodes of a whole BFS layer are added at once, with one random draw per layer
+        for the number of connections, the special cases, the cycle cuts and the new connection directions.
+        The placed positions are kept as sorted int64 keys, merged with each new layer.
+        Notice: Neighbors in the same layer are closed to each other, and the cycles of tree mode are cut when the
+        next layer is added, so a graph has the same statistics as the sequential growth, but not the same nodes.
+        """
+        if num_of_nodes > LAYERED_MAX_NUM_OF_NODES:
+            raise ValueError(f"The layered growth supports up to {LAYERED_MAX_NUM_OF_NODES} nodes")
+
+        # Notice: The NumPy generator is seeded from the graph generator rng, so the graphs stay reproducible
+        np_rng = np.random.default_rng(self.rng.getrandbits(64))
+        available_num_of_connections = np.array(self.available_num_of_connections)
+        num_of_connections_probabilities = np.array(self.num_of_connections_probabilities, dtype=np.float64)
+        num_of_connections_probabilities /= num_of_connections_probabilities.sum()
+        coupler_probability = self.coupler_elbow_probabilities[0] / sum(self.coupler_elbow_probabilities)
+        num_of_connection_types = len(self.connection_types)
+
+        positions = np.empty(shape=(max(num_of_nodes, 0), 3), dtype=np.int64)
+        opened_masks = np.zeros(shape=max(num_of_nodes, 0), dtype=np.uint8)
+        placed_keys = np.empty(shape=0, dtype=np.int64)
+        placed_nodes = np.empty(shape=0, dtype=np.int64)
+        current_num_of_nodes = 0
+
+        layer_positions = np.zeros(shape=(min(max(num_of_nodes, 0), 1), 3), dtype=np.int64)
+        while len(layer_positions) > 0:
+            layer_size = len(layer_positions)
+            layer_nodes = np.arange(current_num_of_nodes, current_num_of_nodes + layer_size)
+            layer_rows = np.arange(layer_size)
+            neighbor_positions = layer_positions[:, np.newaxis, :] + CONNECTION_TYPE_DELTAS_ARRAY[np.newaxis, :, :]
+            neighbor_keys = get_position_keys(positions=neighbor_positions)
+
+            # Placed neighbors: opened if they have an opened connection to the node, otherwise closed
+            lookup_indices, is_placed = lookup_position_keys(sorted_keys=placed_keys, keys=neighbor_keys)
+            neighbor_nodes = np.full(shape=neighbor_keys.shape, fill_value=-1, dtype=np.int64)
+            neighbor_nodes[is_placed] = placed_nodes[lookup_indices[is_placed]]
+            neighbor_masks = opened_masks[np.maximum(neighbor_nodes, 0)]
+            opened = is_placed & ((neighbor_masks & OPPOSITE_CONNECTION_TYPE_INDEX_BITS) != 0)
+            closed = is_placed & ~opened
+
+            # Neighbors in the same layer are closed
+            layer_keys = get_position_keys(positions=layer_positions)
+            layer_order = np.argsort(layer_keys, kind="stable")
+            _, is_layer_neighbor = lookup_position_keys(sorted_keys=layer_keys[layer_order], keys=neighbor_keys)
+            closed |= is_layer_neighbor
+
+            # Tree mode: keep a random opened connection, and close the others (on both sides)
+            if tree_mode is True:
+                cut_rows = np.flatnonzero(opened.sum(axis=1) > 1)
+                if len(cut_rows) > 0:
+                    keep_keys = np_rng.random(size=(len(cut_rows), num_of_connection_types))
+                    keep_keys[~opened[cut_rows]] = -1.0
+                    kept = np.zeros(shape=(len(cut_rows), num_of_connection_types), dtype=bool)
+                    kept[np.arange(len(cut_rows)), keep_keys.argmax(axis=1)] = True
+                    disabled = opened[cut_rows] & ~kept
+
+                    disabled_rows, disabled_columns = np.nonzero(disabled)
+                    np.bitwise_and.at(
+                        opened_masks,
+                        neighbor_nodes[cut_rows[disabled_rows], disabled_columns],
+                        ~OPPOSITE_CONNECTION_TYPE_INDEX_BITS[disabled_columns]
+                    )
+                    opened[cut_rows] = kept
+                    closed[cut_rows] |= disabled
+
+            # Number of new connections to reach the min number of connections
+            selectable = ~opened & ~closed
+            num_of_opened_connections = opened.sum(axis=1)
+            num_of_selectable_connections = selectable.sum(axis=1)
+            min_num_of_connections = np_rng.choice(
+                available_num_of_connections,
+                size=layer_size,
+                p=num_of_connections_probabilities
+            )
+            num_of_choices_available = np.clip(min_num_of_connections - num_of_opened_connections, 0, None)
+            num_of_choices_available = np.minimum(num_of_choices_available, num_of_selectable_connections)
+
+            # Special case: select between Coupler (the opposite connection only) and Elbow (any other connection)
+            eligible = selectable.copy()
+            if self.allow_special_cases is True:
+                opposite_columns = opened.argmax(axis=1) ^ 1
+                special = (
+                    (min_num_of_connections - num_of_opened_connections == 1) &
+                    (num_of_opened_connections == 1) &
+                    selectable[layer_rows, opposite_columns] &
+                    (num_of_selectable_connections > 1)
+                )
+                coupler = special & (np_rng.random(size=layer_size) < coupler_probability)
+                eligible[coupler] = False
+                eligible[coupler, opposite_columns[coupler]] = True
+                elbow = special & ~coupler
+                eligible[elbow, opposite_columns[elbow]] = False
+
+            # Randomly select the new connections: the k eligible connections with the highest random keys
+            selection_keys = np_rng.random(size=(layer_size, num_of_connection_types))
+            selection_keys[~eligible] = -1.0
+            selection_ranks = np.empty(shape=selection_keys.shape, dtype=np.int64)
+            np.put_along_axis(
+                selection_ranks,
+                np.argsort(-selection_keys, axis=1, kind="stable"),
+                np.broadcast_to(np.arange(num_of_connection_types), selection_keys.shape),
+                axis=1
+            )
+            new_connections = eligible & (selection_ranks < num_of_choices_available[:, np.newaxis])
+
+            # Add the layer nodes
+            positions[layer_nodes] = layer_positions
+            opened_masks[layer_nodes] = ((opened | new_connections) * CONNECTION_TYPE_INDEX_BITS).sum(axis=1)
+            current_num_of_nodes += layer_size
+
+            # Merge the layer keys into the placed keys (two sorted runs, so the stable sort is linear)
+            merged_keys = np.concatenate([placed_keys, layer_keys[layer_order]])
+            merged_nodes = np.concatenate([placed_nodes, layer_nodes[layer_order]])
+            merged_order = np.argsort(merged_keys, kind="stable")
+            placed_keys = merged_keys[merged_order]
+            placed_nodes = merged_nodes[merged_order]
+
+            # Next layer: the new connection positions, without duplicates (in BFS order) and within the budget
+            new_rows, new_columns = np.nonzero(new_connections)
+            _, first_indices = np.unique(neighbor_keys[new_rows, new_columns], return_index=True)
+            first_indices = np.sort(first_indices)[:num_of_nodes - current_num_of_nodes]
+            layer_positions = neighbor_positions[new_rows[first_indices], new_columns[first_indices]]
+
+        return PipeGraph(
+            positions=positions[:current_num_of_nodes].astype(np.int32),
+            opened_masks=opened_masks[:current_num_of_nodes]
+        )
+
+    def generate_random_3d_nodes_data(self,
+                                      num_of_nodes: int,
+                                      tree_mode: bool = False,
+                                      output_filepath=None,
+                                      growth_mode: str = "sequential") -> dict:
+        pipe_graph = self.generate_random_3d_pipe_graph(
+            num_of_nodes=num_of_nodes,
+            tree_mode=tree_mode,
+            growth_mode=growth_mode
+        )
+        nodes_data = pipe_graph.to_nodes_data()
+
         if output_filepath is not None:
-            # Notice: Cast the node positions to list to save them in the json file
-            for node_idx, node_data in nodes_data.items():
-                nodes_data[node_idx]["position"] = list(node_data["position"])
             with open(output_filepath, "w") as fp:
                 json.dump(obj=nodes_data, fp=fp, indent=4)
         return nodes_data
 
-    def generate_graph_3d(self, nodes_data: dict) -> nx.Graph:
+    def generate_graph_3d(self, nodes_data: dict) -> "nx.Graph":
+        if nx is None:
+            raise ImportError("networkx is required to generate the networkx graph (use PipeGraph instead)")
+
         # Notice: Cast the node positions to tuple to use them as keys in the dictionary (json doesn't support tuples)
         for node_idx, node_data in nodes_data.items():
             nodes_data[node_idx]["position"] = tuple(node_data["position"])
@@ -299,36 +489,60 @@ class GraphGenerator:
         return graph
 
     @staticmethod
-    def plot_graph_3d(graph: nx.Graph, scale: int = 1, output_filepath=None):
+    def plot_graph_3d(graph: Union["nx.Graph", PipeGraph],
+                      scale: int = 1,
+                      output_filepath=None,
+                      show_labels: bool = True,
+                      max_num_of_labels: int = 100):
         """
         Plot the 3D graph using matplotlib and display connections.
+        All the edges are drawn as a single line collection and all the nodes as a single scatter.
 
         Parameters:
-            graph (networkx.Graph): A graph object.
+            graph (networkx.Graph or PipeGraph): A graph object.
             scale (int): A scale factor for the plot.
             output_filepath (str): An output file path to save the plot (if not provided: plt.show() will be executed).
+            show_labels (bool): Whether to draw the node labels.
+            max_num_of_labels (int): The max number of drawn labels (larger graphs get evenly thinned labels).
         """
-        positions = nx.get_node_attributes(graph, "position")
-
-        fig = plt.figure()
+        if isinstance(graph, PipeGraph):
+            node_ids = graph.get_node_ids()
+            node_positions = graph.positions.astype(np.float64) * scale
+            edges = graph.get_edges()
+        else:
+            positions = nx.get_node_attributes(graph, "position")
+            node_ids = list(positions.keys())
+            node_positions = np.array([positions[node] for node in node_ids], dtype=np.float64).reshape(-1, 3) * scale
+            node_indices = {node: node_idx for node_idx, node in enumerate(node_ids)}
+            edges = np.array(
+                [(node_indices[edge[0]], node_indices[edge[1]]) for edge in graph.edges()],
+                dtype=np.int64
+            ).reshape(-1, 2)
+
+        # Notice: Saved plots are rendered on a standalone Agg canvas (no pyplot state and no GUI backend)
+        if output_filepath is not None:
+            fig = Figure()
+            FigureCanvasAgg(fig)
+        else:
+            fig = plt.figure()
         ax = fig.add_subplot(111, projection="3d")
 
         # Draw edges
-        for edge in graph.edges():
-            x = [positions[edge[0]][0] * scale, positions[edge[1]][0] * scale]
-            y = [positions[edge[0]][1] * scale, positions[edge[1]][1] * scale]
-            z = [positions[edge[0]][2] * scale, positions[edge[1]][2] * scale]
-            ax.plot(x, y, z, color="red", linewidth=1)
+        ax.add_collection3d(Line3DCollection(node_positions[edges], colors="red", linewidths=1))
 
         # Draw nodes and labels
-        for node, (x, y, z) in positions.items():
-            x, y, z = x * scale, y * scale, z * scale
-            ax.scatter(x, y, z, c="blue", s=25)
-            ax.text(x, y, z, s=str(node), color="red", fontsize=8)
+        ax.scatter(
+            node_positions[:, 0], node_positions[:, 1], node_positions[:, 2],
+            c="blue", s=25, depthshade=False
+        )
+        if show_labels is True and len(node_ids) > 0:
+            label_step = -(-len(node_ids) // max(max_num_of_labels, 1))
+            for node_idx in range(0, len(node_ids), label_step):
+                x, y, z = node_positions[node_idx]
+                ax.text(x, y, z, s=str(node_ids[node_idx]), color="red", fontsize=8)
 
         if output_filepath is not None:
-            plt.savefig(output_filepath)
-            plt.close(fig)
+            fig.savefig(output_filepath)
         else:
             plt.show()
 
@@ -0,0 +1,116 @@
+import importlib
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import Optional, Union
+import numpy as np
+
+from pipe_graph import PipeGraph
+
+
+# The max time (in seconds) to wait for all the render processes to start
+RENDER_WORKERS_READY_TIMEOUT = 60.0
+
+# Per-process render worker state (initialized once per render process)
+render_worker_state = {}
+
+
+##################
+# Render Workers #
+##################
+def init_render_worker(ready_barrier: threading.Barrier):
+    # Notice: Each render process draws on its own non-interactive backend, and imports the plotting modules now
+    # (so its first render doesn't pay for them)
+    import matplotlib
+    matplotlib.use("Agg")
+    importlib.import_module("graph_generator")
+
+    render_worker_state["ready_barrier"] = ready_barrier
+
+
+def is_render_worker_ready() -> bool:
+    # Notice: Each readiness task waits for the readiness tasks of all the render processes, so a process can't take
+    # two of them, and every process of the pool is started and warmed
+    render_worker_state["ready_barrier"].wait(timeout=RENDER_WORKERS_READY_TIMEOUT)
+    return True
+
+
+def render_graph(positions: np.ndarray,
+                 opened_masks: np.ndarray,
+                 node_ids: Optional[list],
+                 scale: Union[int, float],
+                 output_filepath: str):
+    from graph_generator import GraphGenerator
+
+    pipe_graph = PipeGraph(positions=positions, opened_masks=opened_masks, node_ids=node_ids)
+    GraphGenerator.plot_graph_3d(graph=pipe_graph, scale=scale, output_filepath=output_filepath)
+
+
+##################
+# Graph Renderer #
+##################
+class GraphRenderer:
+    def __init__(self, num_of_workers: int = 1, max_pending_renders: Optional[int] = None):
+        """
+        Render the graph previews (png) in a small dedicated process pool, off the critical path of the generation
+        threads (matplotlib is not thread-safe, so the plots are never drawn in the generation threads).
+        Only the graph arrays are sent to the render processes.
+        :param num_of_workers: The number of render processes.
+        :param max_pending_renders: The max number of submitted renders (None for 4 per render process).
+        When it is reached, submit blocks until a render is done (backpressure).
+        """
+        self.max_pending_renders = max_pending_renders if max_pending_renders is not None else 4 * num_of_workers
+        self.pending_renders = threading.BoundedSemaphore(value=self.max_pending_renders)
+        self.errors_lock = threading.Lock()
+        self.errors = []
+
+        # Notice: Start (and warm) all the render processes now, before any generation thread (forking a
+        # multithreaded process is unsafe)
+        ready_barrier = multiprocessing.Barrier(parties=num_of_workers)
+        self.executor = ProcessPoolExecutor(max_workers=num_of_workers, initializer=init_render_worker,
+                                            initargs=(ready_barrier,))
+        ready_futures = [self.executor.submit(is_render_worker_ready) for _ in range(num_of_workers)]
+        for ready_future in ready_futures:
+            ready_future.result()
+
+    def submit(self, pipe_graph: PipeGraph, scale: Union[int, float], output_filepath: str):
+        """
+        Queue the render of a graph preview (thread-safe).
+        """
+        self.pending_renders.acquire()
+        try:
+            future = self.executor.submit(
+                render_graph,
+                pipe_graph.positions,
+                pipe_graph.opened_masks,
+                pipe_graph.node_ids,
+                scale,
+                output_filepath
+            )
+        except BaseException:
+            self.pending_renders.release()
+            raise
+        future.add_done_callback(self.on_render_done)
+
+    def on_render_done(self, future: Future):
+        self.pending_renders.release()
+        if not future.cancelled() and future.exception() is not None:
+            with self.errors_lock:
+                self.errors.append(future.exception())
+
+    def close(self):
+        """
+        Wait for all the queued renders, and raise the first render error (if any).
+        """
+        self.executor.shutdown(wait=True)
+        if self.errors:
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown(wait=True, cancel_futures=True)
@@ -1,12 +1,317 @@
 import os
+import io
+import contextlib
 import pathlib
-from typing import Union
+import functools
+import random
+import tracemalloc
+from typing import Union, Optional, List, Dict, Iterator, BinaryIO
 from tqdm import tqdm
 import json
-from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
 
 from graph_generator import GraphGenerator
+from pipe_graph import PipeGraph
 from mesh_builder import MeshBuilder
+from pcd_writer import PointCloudWriter
+from procedural_graph import save_procedural_graph, PROCEDURAL_GRAPH_SUFFIX
+from graph_renderer import GraphRenderer
+from pipeline import Pipeline, PipelineStage
+from run_manifest import RunManifest, atomic_output_file, get_run_manifest_filename, get_shard_indices, \
+    merge_run_manifests, get_file_checksum, get_data_checksum
+from dataset_archive import ArchiveWriter, ArchiveReader
+from run_metrics import OutputMetrics, RunMetrics
+
+
+# Per-process worker state (initialized once per worker process)
+worker_state = {}
+
+# The default number of worker threads of each pipeline stage
+PIPELINE_NUM_OF_WORKERS = {"graph": 1, "mesh": 1, "sample": 1, "write": 2}
+
+
+def get_output_seed(master_seed: int, idx: int) -> int:
+    """
+    Derive the seed of a single output from the master seed of the run.
+    The seed depends only on the master seed and the output index, so any output can be regenerated alone.
+    """
+    seed_sequence = np.random.SeedSequence(entropy=master_seed, spawn_key=(idx,))
+    return int(seed_sequence.generate_state(n_words=1)[0])
+
+
+def generate_output_graph(idx: int, output_params: dict) -> dict:
+    """
+    Generate the graph of an output.
+    :return: The output item (index, output path, seed and graph), completed by the next steps.
+    """
+    num_str_format = str(idx + 1).zfill(output_params["zfill_num"])
+    output_path = os.path.join(output_params["output_dir"], num_str_format)
+    seed = get_output_seed(master_seed=output_params["master_seed"], idx=idx)
+    gg = GraphGenerator(rng=random.Random(seed))
+    metrics_params = output_params["metrics"]
+    metrics = OutputMetrics(
+        idx=idx,
+        profile=metrics_params is not None and metrics_params["profile_threshold"] is not None,
+        track_memory=metrics_params is not None and metrics_params["track_memory"]
+    )
+
+    with metrics.stage(name="graph"):
+        pipe_graph = gg.generate_random_3d_pipe_graph(
+            num_of_nodes=output_params["num_of_nodes"],
+            tree_mode=output_params["tree_mode"],
+            growth_mode=output_params["growth_mode"]
+        )
+    metrics.counts["nodes"] = len(pipe_graph)
+    return {"idx": idx, "output_path": output_path, "seed": seed, "pipe_graph": pipe_graph, "metrics": metrics}
+
+
+def plot_output_graph(output_item: dict, output_params: dict, graph_renderer: Optional[GraphRenderer] = None):
+    # Plot the graph (in the render processes, if a graph renderer is given)
+    # Notice: With a graph renderer, only the submit is timed (the render is off the critical path)
+    output_filepath = f"{output_item['output_path']}.png"
+    with output_item["metrics"].stage(name="plot"):
+        if graph_renderer is not None:
+            graph_renderer.submit(pipe_graph=output_item["pipe_graph"], scale=output_params["graph_scale"],
+                                  output_filepath=output_filepath)
+        else:
+            GraphGenerator.plot_graph_3d(graph=output_item["pipe_graph"], scale=output_params["graph_scale"],
+                                         output_filepath=output_filepath)
+
+
+def predict_output_memory(masks: np.ndarray, mb: MeshBuilder, output_params: dict, streaming: bool) -> dict:
+    return mb.predict_memory(
+        masks=masks,
+        use_sample_method=output_params["pcd_use_sample_method"],
+        points_to_sample=output_params["pcd_points_to_sample"],
+        labels=output_params["pcd_labels"],
+        data_format=output_params["pcd_data_format"],
+        streaming=streaming,
+        instanced=output_params["mesh_instanced"]
+    )
+
+
+def route_output_memory(output_item: dict, mb: MeshBuilder, output_params: dict):
+    """
+    Predict the memory footprint of the output from its graph (before its mesh is built), and route it by the memory
+    budget: an output over the budget is routed to the streaming mesh path (if the action is "stream" and it fits
+    the budget this way), otherwise it is refused (it is never built, see write_output).
+    """
+    metrics = output_item["metrics"]
+    memory_budget = output_params["memory_budget"]
+    _, masks, _ = mb.get_pipe_graph_arrays(pipe_graph=output_item["pipe_graph"])
+    predicted_memory = predict_output_memory(masks=masks, mb=mb, output_params=output_params,
+                                             streaming=output_item["mesh_streaming"])
+    if output_params["mesh_instanced"]:
+        memory_route = "instanced"
+    else:
+        memory_route = "streaming" if output_item["mesh_streaming"] else "built"
+
+    if memory_budget is not None and predicted_memory["peak"] > memory_budget["budget_bytes"]:
+        memory_route = "refused"
+        if memory_budget["action"] == "stream" and not (output_item["mesh_streaming"] or
+                                                        output_params["mesh_instanced"]):
+            streaming_predicted_memory = predict_output_memory(masks=masks, mb=mb, output_params=output_params,
+                                                               streaming=True)
+            if streaming_predicted_memory["peak"] <= memory_budget["budget_bytes"]:
+                predicted_memory = streaming_predicted_memory
+                memory_route = "streaming"
+        output_item["mesh_streaming"] = memory_route == "streaming"
+        output_item["refused"] = memory_route == "refused"
+
+    metrics.predicted_memory = predicted_memory
+    metrics.memory_route = memory_route
+    if output_params["metrics"] is not None:
+        metrics.counts["vertices"], metrics.counts["faces"] = mb.get_mesh_size(masks=masks)
+
+
+def build_output_mesh(output_item: dict, mb: MeshBuilder, output_params: dict) -> dict:
+    # Build the mesh (straight from the pipe graph arrays, without a networkx graph)
+    # Notice: In streaming and instanced modes the mesh is written without ever being built (see write_output)
+    output_item["mesh"] = None
+    output_item["mesh_streaming"] = output_params["mesh_streaming"]
+    output_item["refused"] = False
+    if not output_params["output_procedural"] and (output_params["memory_budget"] is not None or
+                                                   output_params["metrics"] is not None):
+        route_output_memory(output_item=output_item, mb=mb, output_params=output_params)
+
+    if not (output_params["output_procedural"] or output_item["mesh_streaming"] or output_params["mesh_instanced"] or
+            output_item["refused"]):
+        with output_item["metrics"].stage(name="mesh_assembly"):
+            output_item["mesh"] = mb.build_mesh(graph=output_item["pipe_graph"], output_only=True)
+    return output_item
+
+
+def sample_output_pcd(output_item: dict, mb: MeshBuilder, output_params: dict) -> dict:
+    # Notice: The point cloud is sampled from the graph by the kit face area tables (it doesn't need the mesh)
+    output_item["points"], output_item["point_labels"] = None, None
+    if not (output_params["output_procedural"] or output_item["refused"]):
+        with output_item["metrics"].stage(name="sampling"):
+            output_item["points"], output_item["point_labels"] = mb.sample_pcd(
+                input_object=output_item["pipe_graph"],
+                use_sample_method=output_params["pcd_use_sample_method"],
+                points_to_sample=output_params["pcd_points_to_sample"],
+                seed=output_item["seed"],
+                labels=output_params["pcd_labels"]
+            )
+        output_item["metrics"].counts["points"] = len(output_item["points"])
+    return output_item
+
+
+def get_manifest_params(output_params: dict) -> dict:
+    # The parameters that determine the outputs (a resumed run only keeps the outputs of the same parameters)
+    # Notice: Without a memory budget the outputs are the same as the outputs of the runs before the memory budget,
+    # so it is left out of the parameters
+    return {
+        key: value for key, value in output_params.items()
+        if key not in ["output_dir", "zfill_num", "metrics"] and not (key == "memory_budget" and value is None)
+    }
+
+
+def finish_output_metrics(output_item: dict, output_params: dict) -> Optional[dict]:
+    metrics_params = output_params["metrics"]
+    if metrics_params is None:
+        return None
+    return output_item["metrics"].finish(profile_dir=metrics_params["profile_dir"],
+                                         profile_threshold=metrics_params["profile_threshold"])
+
+
+@contextlib.contextmanager
+def open_output_file(filepath: str, archive_members: Optional[Dict[str, bytes]] = None) -> Iterator[BinaryIO]:
+    """
+    Open an output file for a binary write: an in-memory file in archive mode (its data is added to the archive
+    members as the file name -> data when the write succeeds), otherwise an atomic output file.
+    """
+    if archive_members is not None:
+        with io.BytesIO() as fp:
+            yield fp
+            archive_members[os.path.basename(filepath)] = fp.getvalue()
+    else:
+        with atomic_output_file(filepath=filepath) as tmp_filepath, open(tmp_filepath, "wb") as fp:
+            yield fp
+
+
+def write_output(output_item: dict, mb: MeshBuilder, output_params: dict) -> dict:
+    """
+    Write the output files (each file atomically), and add the result of the output to the output item:
+    the manifest record of the output (None for an output refused by the memory budget), in archive mode the data of
+    the output files (see ArchiveWriter), and the metrics record of the output (if the metrics are collected).
+    """
+    output_path = output_item["output_path"]
+    pipe_graph = output_item["pipe_graph"]
+    metrics = output_item["metrics"]
+
+    if output_item["refused"]:
+        output_item["result"] = {
+            "key": os.path.basename(output_path),
+            "record": None,
+            "archive_members": None,
+            "metrics": finish_output_metrics(output_item=output_item, output_params=output_params)
+        }
+        return output_item
+
+    # Notice: In archive mode the files are written to in-memory files and never touch the disk, their data is
+    # appended to the archive shards by the main process (the only archive writer)
+    archive_members = {} if output_params["output_archive"] else None
+
+    # Notice: In procedural mode only the binary graph and the kit reference are saved,
+    # the mesh and point cloud are rebuilt on demand (see ProceduralGraphLoader)
+    if output_params["output_procedural"]:
+        output_filepaths = [f"{output_path}{PROCEDURAL_GRAPH_SUFFIX}"]
+        with metrics.stage(name="procedural_write"), \
+                open_output_file(filepath=output_filepaths[0], archive_members=archive_members) as fp:
+            save_procedural_graph(
+                filepath=output_filepaths[0],
+                pipe_graph=pipe_graph,
+                mb=mb,
+                pcd_use_sample_method=output_params["pcd_use_sample_method"],
+                pcd_points_to_sample=output_params["pcd_points_to_sample"],
+                seed=output_item["seed"],
+                fp=fp
+            )
+    else:
+        mesh_file_type = "glb" if output_params["mesh_instanced"] else "obj"
+        output_filepaths = [f"{output_path}.json", f"{output_path}.{mesh_file_type}", f"{output_path}.pcd"]
+
+        with metrics.stage(name="json_write"), \
+                open_output_file(filepath=output_filepaths[0], archive_members=archive_members) as fp:
+            fp.write(pipe_graph.to_json().encode("utf-8"))
+
+        # Notice: In streaming and instanced modes, the mesh write also includes the mesh assembly
+        with metrics.stage(name="mesh_write"), \
+                open_output_file(filepath=output_filepaths[1], archive_members=archive_members) as fp:
+            # Notice: The built meshes are exported without vertex normals, like the streamed meshes, so the memory
+            # budget route doesn't change the data of the obj files (only the order of the vertices and faces)
+            if output_item["mesh"] is not None:
+                fp.write(output_item["mesh"].export(file_type=mesh_file_type, include_normals=False).encode("utf-8"))
+            else:
+                mb.build_mesh(
+                    graph=pipe_graph,
+                    output_filepath=output_filepaths[1],
+                    streaming=output_item["mesh_streaming"],
+                    instanced=output_params["mesh_instanced"],
+                    output_fp=fp
+                )
+
+        with metrics.stage(name="pcd_write"), \
+                open_output_file(filepath=output_filepaths[2], archive_members=archive_members) as fp:
+            writer = PointCloudWriter(filepath=output_filepaths[2], data_format=output_params["pcd_data_format"])
+            writer.write(points=output_item["points"], fields=output_item["point_labels"], fp=fp)
+
+    file_checksums = {}
+    with metrics.stage(name="checksum"):
+        if archive_members is not None:
+            for filename, data in archive_members.items():
+                file_checksums[filename] = get_data_checksum(data=data)
+        else:
+            for output_filepath in output_filepaths:
+                file_checksums[os.path.basename(output_filepath)] = get_file_checksum(filepath=output_filepath)
+
+    # Notice: The graph plots are previews (rendered asynchronously), so they are not part of the manifest
+    record = RunManifest.get_record(
+        idx=output_item["idx"],
+        seed=output_item["seed"],
+        params=get_manifest_params(output_params=output_params),
+        file_checksums=file_checksums
+    )
+    output_item["result"] = {
+        "key": os.path.basename(output_path),
+        "record": record,
+        "archive_members": archive_members,
+        "metrics": finish_output_metrics(output_item=output_item, output_params=output_params)
+    }
+    return output_item
+
+
+def generate_output(idx: int,
+                    mb: MeshBuilder,
+                    output_params: dict,
+                    plot_graph: bool = True,
+                    graph_renderer: Optional[GraphRenderer] = None) -> dict:
+    """
+    :return: The result of the output (see write_output).
+    """
+    output_item = generate_output_graph(idx=idx, output_params=output_params)
+    build_output_mesh(output_item=output_item, mb=mb, output_params=output_params)
+    # Notice: The graph is plotted after the memory route is known (the outputs refused by the budget have no preview)
+    if (plot_graph is True or graph_renderer is not None) and not output_item["refused"]:
+        plot_output_graph(output_item=output_item, output_params=output_params, graph_renderer=graph_renderer)
+    sample_output_pcd(output_item=output_item, mb=mb, output_params=output_params)
+    write_output(output_item=output_item, mb=mb, output_params=output_params)
+    return output_item["result"]
+
+
+def init_worker(mesh_dir: str, mesh_scale: Union[int, float], mesh_apply_scale: float):
+    # Notice: Each worker process renders the graph plots on its own non-interactive backend
+    import matplotlib
+    matplotlib.use("Agg")
+
+    worker_state["mb"] = MeshBuilder(mesh_dir=mesh_dir, mesh_scale=mesh_scale, mesh_apply_scale=mesh_apply_scale)
+
+
+def generate_output_chunk(idx_list: List[int], output_params: dict) -> List[dict]:
+    # Notice: The results are returned to the main process, which is the only manifest (and archive) writer
+    return [generate_output(idx=idx, mb=worker_state["mb"], output_params=output_params) for idx in idx_list]
 
 
 def generate_output_files(num_of_nodes: int,
@@ -18,50 +323,290 @@ def generate_output_files(num_of_nodes: int,
                           mesh_apply_scale: float,
                           pcd_use_sample_method: bool,
                           pcd_points_to_sample: Union[float, int],
-                          enable_multithreading: bool):
-    output_dir = os.path.join(pathlib.Path(__file__).parent, "output")
-    os.makedirs(name=output_dir, exist_ok=True)
+                          growth_mode: str = "sequential",
+                          mesh_streaming: bool = False,
+                          mesh_instanced: bool = False,
+                          pcd_data_format: str = "binary",
+                          pcd_labels: bool = False,
+                          output_procedural: bool = False,
+                          execution_mode: str = "single_thread",
+                          num_of_workers: Optional[int] = None,
+                          num_of_render_workers: int = 1,
+                          chunk_size: int = 1,
+                          max_in_flight_chunks: Optional[int] = None,
+                          pipeline_num_of_workers: Optional[Dict[str, int]] = None,
+                          pipeline_queue_size: int = 2,
+                          master_seed: Optional[int] = None,
+                          resume: bool = False,
+                          output_dir: Optional[str] = None,
+                          num_of_shards: int = 1,
+                          shard_index: int = 0,
+                          output_archive: bool = False,
+                          archive_shard_size: int = 1 << 30,
+                          collect_metrics: bool = False,
+                          metrics_profile_threshold: Optional[float] = None,
+                          metrics_track_memory: bool = False,
+                          memory_budget_mb: Optional[float] = None,
+                          memory_budget_action: str = "stream"):
+    """
+    Generate random pipe models and save their graph, mesh and point cloud files.
+    :param growth_mode: The graph growth: "sequential" (node by node) or "layered" (BFS layer by layer, vectorized).
+    :param mesh_streaming: Write the mesh files in chunks, without building the whole mesh in memory (the obj files
+    have no vertex normals, in both modes).
+    :param mesh_instanced: Write the mesh files as glb scenes of instanced parts (each part mesh is stored once).
+    :param pcd_data_format: The data format of the point cloud files ("ascii", "binary" or "binary_compressed").
+    :param pcd_labels: Write the "node" and "part" (ConnectionTypes index) labels of each point to the point clouds.
+    :param output_procedural: Save only the binary graph and a reference to the kit (a procedural .pf3d file),
+    instead of the json, mesh and point cloud files.
+    :param execution_mode: "single_thread", "multithreading", "multiprocessing" or "pipeline" (graph, mesh, sample
+    and write stages that run concurrently, so the compute overlaps the disk writes).
+    :param num_of_workers: The number of worker threads or processes (None for the executor default).
+    :param num_of_render_workers: The number of graph plot render processes in multithreading and pipeline modes
+    (0 for no graph plots).
+    :param chunk_size: The number of outputs generated by each submitted multiprocessing task.
+    :param max_in_flight_chunks: The max number of submitted multiprocessing tasks (None for twice the workers).
+    :param pipeline_num_of_workers: The number of worker threads of each pipeline stage ("graph", "mesh", "sample"
+    and "write"), the missing stages use the default (see PIPELINE_NUM_OF_WORKERS).
+    :param pipeline_queue_size: The max number of outputs waiting between two pipeline stages (when the writes fall
+    behind, the compute stages block instead of piling up outputs in memory).
+    :param master_seed: The seed of the run, each output seed is derived from it (None for a random master seed,
+    or for the master seed of the manifest when resuming).
+    :param resume: Resume the run of the output directory: only the outputs that are missing from the run manifest,
+    have corrupt files, or were generated with other parameters are generated (otherwise a new manifest is started).
+    :param output_dir: The output directory (None for the "output" directory of the project), e.g. a directory on
+    a shared filesystem for sharded runs.
+    :param num_of_shards: The number of shards of the run (e.g. the number of machines), each shard generates the
+    outputs of indices shard_index, shard_index + num_of_shards, ... and writes its own manifest.
+    The seed of each output depends only on the master seed and its index, so all the shards must use the same
+    master seed, and the sharded outputs are the same as the outputs of a single run (see merge_shards).
+    :param shard_index: The shard of this run (0 to num_of_shards - 1).
+    :param output_archive: Pack the output files into tar archive shards with an offset index (see ArchiveReader),
+    instead of separate files per output (the graph plots are still separate preview files).
+    :param archive_shard_size: The size (in bytes) of each archive shard.
+    :param collect_metrics: Time the stages of each output and count its nodes, vertices, faces and points, into a
+    JSON lines metrics file (see RunMetrics), and print a summary of the run (percentiles and throughput).
+    :param metrics_profile_threshold: Profile each output with cProfile, and dump the profiles of the outliers
+    (the outputs that take more than this number of seconds) to the "profiles" directory (None for no profiling).
+    :param metrics_track_memory: Also track the peak memory of the stages of each output (tracemalloc peaks and sampled
+    RSS), and summarize the peak memory per graph node and against the predicted footprint (see OutputMetrics).
+    :param memory_budget_mb: The memory budget (in MB) of each output (None for no budget), the footprint of each
+    output is predicted from the vertex and face counts of its parts before its mesh is built (see
+    MeshBuilder.predict_memory).
+    :param memory_budget_action: The action for the outputs over the memory budget: "stream" (write their mesh with
+    the streaming mode if it fits the budget this way, otherwise refuse them) or "refuse" (skip them, they are
+    reported and left out of the manifest). The streamed obj files have the same mesh as the built ones (with the
+    vertices and faces in another order, so the files are not byte-identical), and no vertex normals either.
+    """
+    if mesh_streaming is True and mesh_instanced is True:
+        raise ValueError("The mesh streaming and instanced modes are mutually exclusive")
+    # Notice: cProfile profiles one thread at a time, and the threaded modes run several outputs per process at once
+    if metrics_profile_threshold is not None and execution_mode not in ["single_thread", "multiprocessing"]:
+        raise ValueError("The outlier profiles are only supported in the single_thread and multiprocessing modes")
+    # Notice: The tracemalloc peaks are per process, so the outputs must not share a process either
+    if metrics_track_memory is True and (collect_metrics is False or
+                                         execution_mode not in ["single_thread", "multiprocessing"]):
+        raise ValueError("The memory tracking requires the metrics, in the single_thread or multiprocessing mode")
+    if memory_budget_action not in ["stream", "refuse"]:
+        raise ValueError(f"Invalid memory budget action: {memory_budget_action}")
 
-    gg = GraphGenerator()
-    zfill_num = len(str(num_of_outputs))
+    shard_idx_list = get_shard_indices(num_of_outputs=num_of_outputs, shard_index=shard_index,
+                                       num_of_shards=num_of_shards)
 
-    def generate_output(idx, plot_graph=True):
-        num_str_format = str(idx + 1).zfill(zfill_num)
-        output_path = os.path.join(output_dir, num_str_format)
+    if output_dir is None:
+        output_dir = os.path.join(pathlib.Path(__file__).parent, "output")
+    os.makedirs(name=output_dir, exist_ok=True)
 
-        # Generate the graph
-        nodes_data = gg.generate_random_3d_nodes_data(
-            num_of_nodes=num_of_nodes,
-            tree_mode=tree_mode,
-            output_filepath=f"{output_path}.json"
-        )
+    # Notice: The mesh builder is read-only after construction, so a single instance is shared by all the outputs
+    # (this also compiles the kit pack once, before any worker process maps it)
+    mb = MeshBuilder(mesh_dir=mesh_dir, mesh_scale=mesh_scale, mesh_apply_scale=mesh_apply_scale)
+    manifest = RunManifest(filepath=os.path.join(output_dir, get_run_manifest_filename(shard_index, num_of_shards)))
+    if master_seed is None and resume is True:
+        master_seed = manifest.get_master_seed()
+    if master_seed is None:
+        if num_of_shards > 1:
+            raise ValueError("A sharded run requires a master seed (shared by all the shards)")
+        master_seed = random.SystemRandom().randrange(2 ** 32)
+        print(f"Master seed: {master_seed}")
 
-        graph = gg.generate_graph_3d(nodes_data=nodes_data)
-        if plot_graph:
-            gg.plot_graph_3d(graph=graph, scale=graph_scale, output_filepath=f"{output_path}.png")
-
-        # Build the mesh and point cloud
-        mb = MeshBuilder(mesh_dir=mesh_dir, mesh_scale=mesh_scale, mesh_apply_scale=mesh_apply_scale)
-        mesh = mb.build_mesh(graph=graph, output_filepath=f"{output_path}.obj")
-        pcd = mb.build_pcd(
-            input_object=mesh,
-            use_sample_method=pcd_use_sample_method,
-            points_to_sample=pcd_points_to_sample,
-            output_filepath=f"{output_path}.pcd"
-        )
+    output_params = {
+        "master_seed": master_seed,
+        "output_dir": output_dir,
+        "zfill_num": len(str(num_of_outputs)),
+        "num_of_nodes": num_of_nodes,
+        "tree_mode": tree_mode,
+        "growth_mode": growth_mode,
+        "graph_scale": graph_scale,
+        "kit_hash": mb.part_kit.kit_hash,
+        "mesh_scale": mesh_scale,
+        "mesh_apply_scale": mesh_apply_scale,
+        "mesh_streaming": mesh_streaming,
+        "mesh_instanced": mesh_instanced,
+        "pcd_use_sample_method": pcd_use_sample_method,
+        "pcd_points_to_sample": pcd_points_to_sample,
+        "pcd_data_format": pcd_data_format,
+        "pcd_labels": pcd_labels,
+        "output_procedural": output_procedural,
+        "output_archive": output_archive,
+        "memory_budget": {
+            "budget_bytes": int(memory_budget_mb * 2 ** 20),
+            "action": memory_budget_action
+        } if memory_budget_mb is not None else None,
+        "metrics": {
+            "profile_threshold": metrics_profile_threshold,
+            "profile_dir": os.path.join(output_dir, "profiles"),
+            "track_memory": metrics_track_memory
+        } if collect_metrics is True else None
+    }
+
+    # Notice: Each shard of the run writes its own archive shards
+    archive_prefix = "archive" if num_of_shards == 1 else f"archive-{shard_index:05d}-of-{num_of_shards:05d}"
 
-    if enable_multithreading:
-        futures = []
-        with ThreadPoolExecutor() as executor:
-            # Submit all tasks
-            for idx in range(num_of_outputs):
-                futures.append(executor.submit(generate_output, idx=idx, plot_graph=False))
-            # "Join" on all tasks by waiting for each future to complete.
-            for future in tqdm(futures, total=num_of_outputs, desc="Multithreaded generation"):
-                future.result()
+    # Notice: Each output is recorded in the manifest only after all its files are written (atomically)
+    if resume is True:
+        archive_reader = ArchiveReader(archive_dir=output_dir, prefix=archive_prefix)
+        idx_list = manifest.get_pending_indices(indices=shard_idx_list,
+                                                params=get_manifest_params(output_params=output_params),
+                                                archive_reader=archive_reader)
+        archive_reader.close()
+        print(f"Resuming: {len(shard_idx_list) - len(idx_list)} verified outputs, {len(idx_list)} outputs to generate")
     else:
-        for idx in tqdm(range(num_of_outputs), desc="Single-threaded generation"):
-            generate_output(idx=idx, plot_graph=True)
+        idx_list = shard_idx_list
+        manifest.reset()
+
+    archive_writer = None
+    if output_archive is True:
+        archive_writer = ArchiveWriter(archive_dir=output_dir, prefix=archive_prefix, max_shard_size=archive_shard_size)
+
+    run_metrics = None
+    if collect_metrics is True:
+        metrics_filename = "metrics.jsonl" if num_of_shards == 1 else \
+            f"metrics-{shard_index:05d}-of-{num_of_shards:05d}.jsonl"
+        run_metrics = RunMetrics(filepath=os.path.join(output_dir, metrics_filename))
+
+    # Notice: The outputs refused by the memory budget are not recorded, so they are pending again on resume
+    refused_keys = []
+    is_tracing_memory = tracemalloc.is_tracing()
+
+    def complete_output(output_result: dict):
+        # Notice: The outputs of an archive shard that was never completed (a killed run) are generated again on resume
+        record = output_result["record"]
+        if record is None:
+            refused_keys.append(output_result["key"])
+        else:
+            if archive_writer is not None:
+                record["archive"] = archive_writer.write(key=output_result["key"],
+                                                         members=output_result["archive_members"])
+            manifest.append(record=record)
+        if run_metrics is not None:
+            run_metrics.append(record=output_result["metrics"])
+
+    try:
+        if execution_mode == "multiprocessing":
+            num_of_workers = num_of_workers if num_of_workers is not None else os.cpu_count()
+            if max_in_flight_chunks is None:
+                max_in_flight_chunks = 2 * num_of_workers
+            idx_chunks = [
+                idx_list[chunk_start:chunk_start + chunk_size]
+                for chunk_start in range(0, len(idx_list), chunk_size)
+            ]
+
+            with ProcessPoolExecutor(max_workers=num_of_workers,
+                                     initializer=init_worker,
+                                     initargs=(mesh_dir, mesh_scale, mesh_apply_scale)) as executor, \
+                    tqdm(total=len(idx_list), desc="Multiprocess generation") as progress_bar:
+                def collect(done_futures):
+                    for future in done_futures:
+                        output_results = future.result()
+                        for output_result in output_results:
+                            complete_output(output_result=output_result)
+                        progress_bar.update(len(output_results))
+
+                pending_futures = set()
+                for idx_chunk in idx_chunks:
+                    # Bound the in-flight work, and collect the results as they complete
+                    if len(pending_futures) >= max_in_flight_chunks:
+                        done_futures, pending_futures = wait(pending_futures, return_when=FIRST_COMPLETED)
+                        collect(done_futures=done_futures)
+                    pending_futures.add(executor.submit(generate_output_chunk, idx_chunk, output_params))
+
+                while pending_futures:
+                    done_futures, pending_futures = wait(pending_futures, return_when=FIRST_COMPLETED)
+                    collect(done_futures=done_futures)
+
+        elif execution_mode == "multithreading":
+            # Notice: Matplotlib is not thread-safe, so the graph plots are rendered by a separate process pool,
+            # which is fed the graph arrays while the generation threads keep going
+            graph_renderer = GraphRenderer(num_of_workers=num_of_render_workers) if num_of_render_workers > 0 else None
+            try:
+                futures = []
+                with ThreadPoolExecutor(max_workers=num_of_workers) as executor:
+                    # Submit all tasks
+                    for idx in idx_list:
+                        futures.append(executor.submit(
+                            generate_output, idx=idx, mb=mb, output_params=output_params, plot_graph=False,
+                            graph_renderer=graph_renderer
+                        ))
+                    # "Join" on all tasks by waiting for each future to complete.
+                    for future in tqdm(futures, total=len(idx_list), desc="Multithreaded generation"):
+                        complete_output(output_result=future.result())
+            finally:
+                if graph_renderer is not None:
+                    graph_renderer.close()
+
+        elif execution_mode == "pipeline":
+            stage_num_of_workers = {**PIPELINE_NUM_OF_WORKERS, **(pipeline_num_of_workers or {})}
+            graph_renderer = GraphRenderer(num_of_workers=num_of_render_workers) if num_of_render_workers > 0 else None
+
+            def build_mesh(output_item: dict) -> dict:
+                # Notice: The graph is plotted after the memory route is known (the refused outputs have no preview)
+                build_output_mesh(output_item=output_item, mb=mb, output_params=output_params)
+                if graph_renderer is not None and not output_item["refused"]:
+                    plot_output_graph(output_item=output_item, output_params=output_params,
+                                      graph_renderer=graph_renderer)
+                return output_item
+
+            pipeline = Pipeline(
+                stages=[
+                    PipelineStage(name="graph",
+                                  function=functools.partial(generate_output_graph, output_params=output_params),
+                                  num_of_workers=stage_num_of_workers["graph"]),
+                    PipelineStage(name="mesh", function=build_mesh, num_of_workers=stage_num_of_workers["mesh"]),
+                    PipelineStage(name="sample",
+                                  function=functools.partial(sample_output_pcd, mb=mb, output_params=output_params),
+                                  num_of_workers=stage_num_of_workers["sample"]),
+                    PipelineStage(name="write",
+                                  function=functools.partial(write_output, mb=mb, output_params=output_params),
+                                  num_of_workers=stage_num_of_workers["write"])
+                ],
+                queue_size=pipeline_queue_size
+            )
+            try:
+                for output_item in tqdm(pipeline.run(items=idx_list), total=len(idx_list), desc="Pipelined generation"):
+                    complete_output(output_result=output_item["result"])
+            finally:
+                if graph_renderer is not None:
+                    graph_renderer.close()
+
+        elif execution_mode == "single_thread":
+            for idx in tqdm(idx_list, desc="Single-threaded generation"):
+                complete_output(output_result=generate_output(idx=idx, mb=mb, output_params=output_params,
+                                                              plot_graph=True))
+
+        else:
+            raise ValueError(f"Invalid execution mode: {execution_mode}")
+    finally:
+        # Notice: The last archive shard is completed even if the run fails, so its outputs are kept on resume
+        if archive_writer is not None:
+            archive_writer.close()
+        # Notice: The tracing of the single_thread memory tracking is stopped (it slows down the allocations)
+        if not is_tracing_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    if len(refused_keys) > 0:
+        print(f"Refused {len(refused_keys)} outputs over the memory budget: {', '.join(sorted(refused_keys)[:10])}"
+              f"{', ...' if len(refused_keys) > 10 else ''}")
+    if run_metrics is not None:
+        run_metrics.summarize()
 
 
 def build_mesh_from_json(json_filepath: str,
@@ -79,12 +624,12 @@ def build_mesh_from_json(json_filepath: str,
         nodes_data = json.load(fp=fp)
 
     gg = GraphGenerator()
-    graph = gg.generate_graph_3d(nodes_data=nodes_data)
-    gg.plot_graph_3d(graph=graph, scale=graph_scale, output_filepath=f"{output_path}.png")
+    pipe_graph = PipeGraph.from_nodes_data(nodes_data=nodes_data)
+    gg.plot_graph_3d(graph=pipe_graph, scale=graph_scale, output_filepath=f"{output_path}.png")
 
     # Build the mesh and point cloud
     mb = MeshBuilder(mesh_dir=mesh_dir, mesh_scale=mesh_scale, mesh_apply_scale=mesh_apply_scale)
-    mesh = mb.build_mesh(graph=graph, output_filepath=f"{output_path}.obj")
+    mesh = mb.build_mesh(graph=pipe_graph, output_filepath=f"{output_path}.obj")
     pcd = mb.build_pcd(
         input_object=mesh,
         use_sample_method=pcd_use_sample_method,
@@ -101,19 +646,44 @@ def generate_data():
     num_of_nodes = 100
     num_of_outputs = 50
     tree_mode = True
+    growth_mode = "sequential"  # "sequential" or "layered"
     graph_scale = 1
 
     # Mesh Parameters
     mesh_dir = "connection_types"
     mesh_scale = 66
     mesh_apply_scale = 1.0
+    mesh_streaming = False
+    mesh_instanced = False
 
     # Point Cloud Parameters
     pcd_use_sample_method = True
     pcd_points_to_sample = 1.0
+    pcd_data_format = "binary"  # "ascii", "binary" or "binary_compressed"
+    pcd_labels = False
 
-    # Multithreading Parameters
-    enable_multithreading = True
+    # Output Parameters
+    output_procedural = False
+
+    # Execution Parameters
+    execution_mode = "multiprocessing"  # "single_thread", "multithreading", "multiprocessing" or "pipeline"
+    num_of_workers = None
+    num_of_render_workers = 1
+    chunk_size = 1
+    pipeline_num_of_workers = None  # e.g. {"graph": 1, "mesh": 1, "sample": 1, "write": 2}
+    pipeline_queue_size = 2
+    master_seed = None  # None for a random run
+    resume = False  # True to resume the run of the output directory (see the run manifest)
+    output_dir = None  # None for the "output" directory of the project
+    num_of_shards = 1
+    shard_index = 0  # The shard of this machine (0 to num_of_shards - 1), see merge_shards
+    output_archive = False
+    archive_shard_size = 1 << 30
+    collect_metrics = False
+    metrics_profile_threshold = None  # e.g. 10.0 to profile the outputs that take more than 10 seconds
+    metrics_track_memory = False
+    memory_budget_mb = None  # e.g. 2048 to keep each output under 2 GB (see memory_budget_action)
+    memory_budget_action = "stream"  # "stream" or "refuse"
 
     generate_output_files(
         num_of_nodes=num_of_nodes,
@@ -125,8 +695,47 @@ def generate_data():
         mesh_apply_scale=mesh_apply_scale,
         pcd_use_sample_method=pcd_use_sample_method,
         pcd_points_to_sample=pcd_points_to_sample,
-        enable_multithreading=enable_multithreading
+        growth_mode=growth_mode,
+        mesh_streaming=mesh_streaming,
+        mesh_instanced=mesh_instanced,
+        pcd_data_format=pcd_data_format,
+        pcd_labels=pcd_labels,
+        output_procedural=output_procedural,
+        execution_mode=execution_mode,
+        num_of_workers=num_of_workers,
+        num_of_render_workers=num_of_render_workers,
+        chunk_size=chunk_size,
+        pipeline_num_of_workers=pipeline_num_of_workers,
+        pipeline_queue_size=pipeline_queue_size,
+        master_seed=master_seed,
+        resume=resume,
+        output_dir=output_dir,
+        num_of_shards=num_of_shards,
+        shard_index=shard_index,
+        output_archive=output_archive,
+        archive_shard_size=archive_shard_size,
+        collect_metrics=collect_metrics,
+        metrics_profile_threshold=metrics_profile_threshold,
+        metrics_track_memory=metrics_track_memory,
+        memory_budget_mb=memory_budget_mb,
+        memory_budget_action=memory_budget_action
+    )
+
+
+def merge_shards():
+    # Run Parameters
+    output_dir = "output"
+    num_of_outputs = 50
+    num_of_shards = 4
+    verify = False  # True to also verify the checksums of all the output files
+
+    index_filepath = merge_run_manifests(
+        output_dir=output_dir,
+        num_of_outputs=num_of_outputs,
+        num_of_shards=num_of_shards,
+        verify=verify
     )
+    print(f"All the {num_of_outputs} outputs are covered, global index: {index_filepath}")
 
 
 def build_data_from_json():
@@ -158,6 +767,7 @@ def build_data_from_json():
 
 def main():
     generate_data()
+    # merge_shards()
     # build_data_from_json()
 
 
@@ -1,377 +1,674 @@
-from enum import Enum
 import pathlib
 import os
-import networkx as nx
 import numpy as np
 import trimesh
-import open3d as o3d
-from typing import Callable, Union, Tuple, List
-
-
-class ConnectionTypes(Enum):
-    Cap = "Cap.obj"
-    Coupler = "Coupler.obj"
-    Elbow = "Elbow.obj"
-    Tee = "Tee.obj"
-    ThreeWayElbow = "ThreeWayElbow.obj"
-    Cross = "Cross.obj"
-    FourWayTee = "FourWayTee.obj"
-    FiveWayTee = "FiveWayTee.obj"
-    Hexagonal = "Hexagonal.obj"
+from typing import Union, Tuple, List, Optional, Iterator, Dict, BinaryIO
+
+# Notice: networkx is optional (the graphs are built from PipeGraph objects, networkx graphs are also accepted)
+try:
+    import networkx as nx
+except ImportError:
+    nx = None
+
+from part_kit import ConnectionTypes, PartKit, KIT_PACK_FILENAME
+from pipe_graph import PipeGraph, CONNECTION_TYPE_BITS, connections_to_mask
+from mesh_writer import StreamingMeshWriter, InstancedMeshWriter
+from pcd_writer import PointCloudWriter
+
+
+# Connections -> (connection type, rotations in the origin), every rotation is pi / 2 around the given direction
+CONNECTIONS_ORIENTATIONS = {
+    # Cap
+    ("x",): (ConnectionTypes.Cap, [[0, 0, 1]]),
+    ("-x",): (ConnectionTypes.Cap, [[0, 0, -1]]),
+    ("y",): (ConnectionTypes.Cap, [[1, 0, 0], [1, 0, 0]]),
+    ("-y",): (ConnectionTypes.Cap, []),  # No need to rotate the cap
+    ("z",): (ConnectionTypes.Cap, [[-1, 0, 0]]),
+    ("-z",): (ConnectionTypes.Cap, [[1, 0, 0]]),
+    # Coupler
+    ("x", "-x"): (ConnectionTypes.Coupler, [[0, 0, 1]]),
+    ("y", "-y"): (ConnectionTypes.Coupler, []),  # No need to rotate the coupler
+    ("z", "-z"): (ConnectionTypes.Coupler, [[1, 0, 0]]),
+    # Elbow
+    ("x", "y"): (ConnectionTypes.Elbow, [[0, 1, 0], [0, 0, 1]]),
+    ("x", "-y"): (ConnectionTypes.Elbow, [[0, 1, 0]]),
+    ("-x", "y"): (ConnectionTypes.Elbow, [[0, -1, 0], [0, 0, -1]]),
+    ("-x", "-y"): (ConnectionTypes.Elbow, [[0, -1, 0]]),
+    ("x", "z"): (ConnectionTypes.Elbow, [[0, 0, 1]]),
+    ("x", "-z"): (ConnectionTypes.Elbow, [[0, 0, 1], [0, 1, 0]]),
+    ("-x", "z"): (ConnectionTypes.Elbow, [[0, 0, -1]]),
+    ("-x", "-z"): (ConnectionTypes.Elbow, [[0, 0, -1], [0, -1, 0]]),
+    ("y", "z"): (ConnectionTypes.Elbow, [[-1, 0, 0]]),
+    ("y", "-z"): (ConnectionTypes.Elbow, [[1, 0, 0], [1, 0, 0]]),
+    ("-y", "z"): (ConnectionTypes.Elbow, []),  # No need to rotate the elbow
+    ("-y", "-z"): (ConnectionTypes.Elbow, [[1, 0, 0]]),
+    # Tee
+    ("x", "-x", "y"): (ConnectionTypes.Tee, [[-1, 0, 0], [0, 1, 0]]),
+    ("x", "-x", "-y"): (ConnectionTypes.Tee, [[1, 0, 0], [0, 1, 0]]),
+    ("x", "-x", "z"): (ConnectionTypes.Tee, [[0, 0, 1]]),
+    ("x", "-x", "-z"): (ConnectionTypes.Tee, [[0, 0, 1], [0, 1, 0], [0, 1, 0]]),
+    ("x", "y", "-y"): (ConnectionTypes.Tee, [[0, 1, 0]]),
+    ("-x", "y", "-y"): (ConnectionTypes.Tee, [[0, -1, 0]]),
+    ("y", "-y", "z"): (ConnectionTypes.Tee, []),  # No need to rotate the tee
+    ("y", "-y", "-z"): (ConnectionTypes.Tee, [[0, 1, 0], [0, 1, 0]]),
+    ("x", "z", "-z"): (ConnectionTypes.Tee, [[0, 1, 0], [1, 0, 0]]),
+    ("-x", "z", "-z"): (ConnectionTypes.Tee, [[0, -1, 0], [1, 0, 0]]),
+    ("y", "z", "-z"): (ConnectionTypes.Tee, [[-1, 0, 0]]),
+    ("-y", "z", "-z"): (ConnectionTypes.Tee, [[1, 0, 0]]),
+    # Three-Way Elbow
+    ("x", "y", "z"): (ConnectionTypes.ThreeWayElbow, [[-1, 0, 0], [0, 1, 0]]),
+    ("x", "y", "-z"): (ConnectionTypes.ThreeWayElbow, [[-1, 0, 0], [0, 1, 0], [0, 1, 0]]),
+    ("x", "-y", "z"): (ConnectionTypes.ThreeWayElbow, [[0, 1, 0]]),
+    ("x", "-y", "-z"): (ConnectionTypes.ThreeWayElbow, [[0, 1, 0], [0, 1, 0]]),
+    ("-x", "y", "z"): (ConnectionTypes.ThreeWayElbow, [[-1, 0, 0]]),
+    ("-x", "y", "-z"): (ConnectionTypes.ThreeWayElbow, [[-1, 0, 0], [-1, 0, 0]]),
+    ("-x", "-y", "z"): (ConnectionTypes.ThreeWayElbow, []),  # No need to rotate the three-way elbow
+    ("-x", "-y", "-z"): (ConnectionTypes.ThreeWayElbow, [[1, 0, 0]]),
+    # Cross
+    ("x", "-x", "y", "-y"): (ConnectionTypes.Cross, [[0, 1, 0]]),
+    ("x", "-x", "z", "-z"): (ConnectionTypes.Cross, [[0, 0, 1]]),
+    ("y", "-y", "z", "-z"): (ConnectionTypes.Cross, []),  # No need to rotate the cross
+    # Four-Way Tee
+    ("x", "-x", "y", "z"): (ConnectionTypes.FourWayTee, [[0, 0, -1]]),
+    ("x", "-x", "y", "-z"): (ConnectionTypes.FourWayTee, [[0, 0, -1], [-1, 0, 0]]),
+    ("x", "-x", "-y", "z"): (ConnectionTypes.FourWayTee, [[0, 0, 1]]),
+    ("x", "-x", "-y", "-z"): (ConnectionTypes.FourWayTee, [[0, 0, 1], [1, 0, 0]]),
+    ("x", "y", "-y", "z"): (ConnectionTypes.FourWayTee, [[0, 1, 0]]),
+    ("x", "y", "-y", "-z"): (ConnectionTypes.FourWayTee, [[0, 1, 0], [0, 1, 0]]),
+    ("-x", "y", "-y", "z"): (ConnectionTypes.FourWayTee, []),  # No need to rotate the four-way tee
+    ("-x", "y", "-y", "-z"): (ConnectionTypes.FourWayTee, [[0, -1, 0]]),
+    ("x", "y", "z", "-z"): (ConnectionTypes.FourWayTee, [[-1, 0, 0], [0, 0, -1]]),
+    ("x", "-y", "z", "-z"): (ConnectionTypes.FourWayTee, [[1, 0, 0], [0, 0, 1]]),
+    ("-x", "y", "z", "-z"): (ConnectionTypes.FourWayTee, [[-1, 0, 0]]),
+    ("-x", "-y", "z", "-z"): (ConnectionTypes.FourWayTee, [[1, 0, 0]]),
+    # Five-Way Tee
+    ("x", "-x", "y", "-y", "z"): (ConnectionTypes.FiveWayTee, []),  # No need to rotate the five-way tee
+    ("x", "-x", "y", "-y", "-z"): (ConnectionTypes.FiveWayTee, [[1, 0, 0], [1, 0, 0]]),
+    ("x", "-x", "y", "z", "-z"): (ConnectionTypes.FiveWayTee, [[-1, 0, 0]]),
+    ("x", "-x", "-y", "z", "-z"): (ConnectionTypes.FiveWayTee, [[1, 0, 0]]),
+    ("x", "y", "-y", "z", "-z"): (ConnectionTypes.FiveWayTee, [[0, 1, 0]]),
+    ("-x", "y", "-y", "z", "-z"): (ConnectionTypes.FiveWayTee, [[0, -1, 0]]),
+    # Hexagonal
+    ("x", "-x", "y", "-y", "z", "-z"): (ConnectionTypes.Hexagonal, []),  # No need to rotate the hexagonal
+}
+NUM_OF_CONNECTIONS_MASKS = 64
+
+# The bytes of a vertex (3 float64), a face (3 int64) or a point (3 float64), and of the labels of a point
+# ("node" uint32 and "part" uint8)
+MESH_ITEM_SIZE = 24
+POINT_LABELS_SIZE = 5
+
+# The peak allocations of the output stages per byte of the arrays they work on (measured with tracemalloc):
+# the mesh assembly (the vertices and faces arrays and the trimesh), the mesh export (the obj text of the exported
+# arrays), the surface sampling (the per-group temporaries of the points), and the point cloud write per data format
+MEMORY_FACTORS = {
+    "assembly": 1.05,
+    "export": 5.75,
+    "sampling": 2.5,
+    "pcd_ascii": 10.5,
+    "pcd_binary": 1.5,
+    "pcd_binary_compressed": 2.25
+}
 
 
 class MeshBuilder:
     def __init__(self, mesh_dir: str, mesh_scale: Union[int, float], mesh_apply_scale: float = 1.0):
+        self.mesh_dir = mesh_dir
         self.pipe_meshes_path = os.path.join(pathlib.Path(__file__).parent, mesh_dir)
         self.mesh_scale = mesh_scale
         self.mesh_apply_scale = mesh_apply_scale
-        self.pipe_meshes = {}
-        for connection_type in ConnectionTypes:
-            pipe_mesh_path = os.path.join(self.pipe_meshes_path, connection_type.value)
-            self.pipe_meshes[connection_type] = trimesh.load(file_obj=pipe_mesh_path)
-
-        self.connections_cases: dict[int, Callable] = {
-            1: self.cap,
-            2: self.coupler_or_elbow,
-            3: self.tee_or_three_way_elbow,
-            4: self.cross_or_four_way_tee,
-            5: self.five_way_tee,
-            6: self.hexagonal
-        }
-
-    def apply_translation(self, mesh: trimesh.Trimesh, position: Tuple[int, int, int]):
-        position = np.array(position) * self.mesh_scale
-        mesh.apply_translation(position)
-
-    def cap(self, position: Tuple[int, int, int], connections: List[str]) -> trimesh.Trimesh:
-        mesh = self.pipe_meshes[ConnectionTypes.Cap].copy()
-
-        # Rotation (In the origin)
-        if {"x"}.issubset(connections):
-            mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 0, 1]))
-        elif {"-x"}.issubset(connections):
-            mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 0, -1]))
 
-        elif {"y"}.issubset(connections):
-            mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[1, 0, 0]))
-            mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[1, 0, 0]))
-        elif {"-y"}.issubset(connections):
-            pass  # No need to rotate the cap
-
-        elif {"z"}.issubset(connections):
-            mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[-1, 0, 0]))
-        elif {"-z"}.issubset(connections):
-            mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[1, 0, 0]))
+        # Connections mask -> (connection type index, 4x4 transform), -1 for invalid masks
+        self.connection_types = list(ConnectionTypes)
+        self.mask_connection_types, self.mask_transforms = self.build_orientation_table()
+
+        # Load the compiled part kit (the OBJ files are parsed only when the kit pack is missing or stale)
+        # Notice: The hash of each kit file is stored in the procedural graph files, to report which files differ
+        kit_hash, self.kit_file_hashes = PartKit.get_kit_hashes(mesh_dir=self.pipe_meshes_path)
+        self.part_kit_filepath = os.path.join(self.pipe_meshes_path, KIT_PACK_FILENAME)
+        self.part_kit = PartKit.load(filepath=self.part_kit_filepath, kit_hash=kit_hash)
+        if self.part_kit is None:
+            self.compile_part_kit()
+
+        # Every valid (connection type, orientation) pair, resolved once
+        self.oriented_parts: dict[int, Tuple[np.ndarray, np.ndarray]] = {
+            mask: self.part_kit.get_variant(mask=mask)
+            for mask in self.part_kit.variant_parts.keys()
+        }
 
+        # Connections mask -> (number of vertices, number of faces) of the oriented part (0 for invalid masks)
+        self.mask_mesh_sizes = np.zeros(shape=(NUM_OF_CONNECTIONS_MASKS, 2), dtype=np.int64)
+        for mask, (vertices, faces) in self.oriented_parts.items():
+            self.mask_mesh_sizes[mask] = [len(vertices), len(faces)]
+
+        # Connection type index -> cumulative face areas, and connections mask -> total part area (0 for invalid masks)
+        self.part_face_area_cumsums = [
+            np.cumsum(self.part_kit.part_arrays[connection_type]["face_areas"])
+            for connection_type in self.connection_types
+        ]
+        self.mask_areas = np.zeros(shape=NUM_OF_CONNECTIONS_MASKS, dtype=np.float64)
+        for mask in np.flatnonzero(self.mask_connection_types >= 0).tolist():
+            self.mask_areas[mask] = self.part_face_area_cumsums[self.mask_connection_types[mask]][-1]
+
+    def build_orientation_table(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Build the 64-entry table of the 6-bit connections masks.
+        :return: The (64,) connection type indices (-1 for invalid masks) and the (64, 4, 4) transforms.
+        """
+        mask_connection_types = np.full(shape=NUM_OF_CONNECTIONS_MASKS, fill_value=-1, dtype=np.int8)
+        mask_transforms = np.tile(np.eye(4), reps=(NUM_OF_CONNECTIONS_MASKS, 1, 1))
+        for connections, (connection_type, rotation_directions) in CONNECTIONS_ORIENTATIONS.items():
+            mask = connections_to_mask(connections=list(connections))
+            transform = np.eye(4)
+            for direction in rotation_directions:
+                rotation = trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=direction)
+                transform = rotation @ transform
+            mask_connection_types[mask] = self.connection_types.index(connection_type)
+            mask_transforms[mask] = transform
+        return mask_connection_types, mask_transforms
+
+    def compile_part_kit(self):
+        """
+        Parse the connection types OBJ files, resolve the oriented variants and save the kit pack file.
+        """
+        kit_hash, _ = PartKit.get_kit_hashes(mesh_dir=self.pipe_meshes_path)
+        part_meshes = PartKit.load_part_meshes(mesh_dir=self.pipe_meshes_path)
+
+        variant_meshes = {}
+        for mask in np.flatnonzero(self.mask_connection_types >= 0).tolist():
+            connection_type = self.connection_types[self.mask_connection_types[mask]]
+            mesh = part_meshes[connection_type].copy()
+            mesh.apply_transform(self.mask_transforms[mask])
+            variant_meshes[mask] = (connection_type, mesh)
+
+        self.part_kit = PartKit.from_meshes(
+            kit_hash=kit_hash,
+            part_meshes=part_meshes,
+            variant_meshes=variant_meshes
+        )
+        try:
+            self.part_kit.save(filepath=self.part_kit_filepath)
+        except OSError as e:
+            print(f"Failed to save the kit pack file (using the in-memory kit): {e}")
+
+    @staticmethod
+    def get_connections_masks(connections_list: List[List[str]]) -> np.ndarray:
+        """
+        Encode the connections of the nodes as 6-bit masks (0 for invalid or repeated connection types).
+        """
+        masks = np.zeros(shape=len(connections_list), dtype=np.uint8)
+        for node_idx, connections in enumerate(connections_list):
+            mask = 0
+            for connection_type in connections:
+                bit = CONNECTION_TYPE_BITS.get(connection_type, 0)
+                if bit == 0 or mask & bit:
+                    mask = 0
+                    break
+                mask |= bit
+            masks[node_idx] = mask
+        return masks
+
+    def classify_connections(self, masks: np.ndarray, node_ids: Optional[list] = None) -> np.ndarray:
+        """
+        Classify all the nodes at once, and report the nodes with invalid connections in bulk.
+        :param masks: The (N,) connections masks.
+        :param node_ids: The node ids (for the report).
+        :return: The (N,) connection type indices (-1 for invalid connections).
+        """
+        connection_type_indices = self.mask_connection_types[masks]
+        invalid_node_indices = np.flatnonzero(connection_type_indices < 0)
+        if len(invalid_node_indices) > 0:
+            invalid_nodes = invalid_node_indices.tolist() if node_ids is None else \
+                [node_ids[node_idx] for node_idx in invalid_node_indices.tolist()]
+            print(f"Invalid connections in {len(invalid_nodes)} nodes (skipped): {invalid_nodes[:10]}"
+                  f"{' ...' if len(invalid_nodes) > 10 else ''}")
+        return connection_type_indices
+
+    def get_mesh_size(self, masks: np.ndarray) -> Tuple[int, int]:
+        """
+        The number of vertices and faces of the mesh of the given (valid) connections masks.
+        """
+        mask_counts = np.bincount(masks, minlength=NUM_OF_CONNECTIONS_MASKS)
+        num_of_vertices, num_of_faces = (mask_counts @ self.mask_mesh_sizes).tolist()
+        return num_of_vertices, num_of_faces
+
+    @staticmethod
+    def get_num_of_points(num_of_vertices: int,
+                          use_sample_method: bool = True,
+                          points_to_sample: Union[float, int] = 1.0) -> int:
+        """
+        The number of points of the point cloud of a mesh of the given number of vertices (see sample_pcd).
+        """
+        if use_sample_method is False:
+            return num_of_vertices
+        # If float, sample the percentage of the points
+        if isinstance(points_to_sample, float):
+            return int(num_of_vertices * points_to_sample)
+        # If int, sample the number of points
+        return points_to_sample
+
+    def predict_memory(self,
+                       masks: np.ndarray,
+                       use_sample_method: bool = True,
+                       points_to_sample: Union[float, int] = 1.0,
+                       labels: bool = False,
+                       data_format: str = "binary",
+                       streaming: bool = False,
+                       streaming_chunk_size: int = 256,
+                       instanced: bool = False) -> Dict[str, int]:
+        """
+        Predict the memory footprint of an output from its (valid) connections masks, before building anything:
+        the sizes of the mesh and point arrays (from the vertex and face counts of the oriented parts), scaled by the
+        peak allocations of each stage (see MEMORY_FACTORS).
+        The built mesh and the points are held until the output is written, so they are added to the later stages.
+        :param masks: The (N,) connections masks.
+        :return: The predicted peak bytes of the "mesh_assembly", "sampling", "mesh_write" and "pcd_write" stages
+        (see build_mesh, sample_pcd and PointCloudWriter), and their max ("peak").
+        """
+        num_of_vertices, num_of_faces = self.get_mesh_size(masks=masks)
+        mesh_bytes = (num_of_vertices + num_of_faces) * MESH_ITEM_SIZE
+        num_of_points = self.get_num_of_points(num_of_vertices=num_of_vertices, use_sample_method=use_sample_method,
+                                               points_to_sample=points_to_sample)
+        points_bytes = num_of_points * (MESH_ITEM_SIZE + (POINT_LABELS_SIZE if labels is True else 0))
+
+        # Notice: In streaming and instanced modes the mesh is never built, only a chunk of nodes (or each oriented
+        # part mesh once) is exported at a time
+        if instanced is True:
+            held_mesh_bytes = 0
+            export_bytes = int(self.mask_mesh_sizes[np.unique(masks)].sum()) * MESH_ITEM_SIZE
+        elif streaming is True:
+            held_mesh_bytes = 0
+            node_mesh_sizes = self.mask_mesh_sizes[masks].sum(axis=1)
+            chunk_starts = np.arange(0, len(masks), streaming_chunk_size)
+            export_bytes = int(np.add.reduceat(node_mesh_sizes, chunk_starts).max()) * MESH_ITEM_SIZE \
+                if len(masks) > 0 else 0
         else:
-            raise ValueError("Invalid connections for cap")
+            held_mesh_bytes = mesh_bytes
+            export_bytes = mesh_bytes
 
-        # Translation
-        self.apply_translation(mesh=mesh, position=position)
-        return mesh
-
-    def coupler_or_elbow(self, position: Tuple[int, int, int], connections: List[str]) -> trimesh.Trimesh:
-        if connections[0].strip("-") == connections[1].strip("-"):  # Coupler
-            mesh = self.pipe_meshes[ConnectionTypes.Coupler].copy()
-
-            # Rotation (In the origin)
-            if {"x", "-x"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 0, 1]))
-            elif {"y", "-y"}.issubset(connections):
-                pass  # No need to rotate the coupler
-            elif {"z", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[1, 0, 0]))
-
-            else:
-                raise ValueError("Invalid connections for coupler")
-
-        else:  # Elbow
-            mesh = self.pipe_meshes[ConnectionTypes.Elbow].copy()
-
-            # Rotation (In the origin)
-            if {"x", "y"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 0, 1]))
-            elif {"x", "-y"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-            elif {"-x", "y"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, -1, 0]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 0, -1]))
-            elif {"-x", "-y"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, -1, 0]))
-            
-            elif {"x", "z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 0, 1]))
-            elif {"x", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 0, 1]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-            elif {"-x", "z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 0, -1]))
-            elif {"-x", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 0, -1]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, -1, 0]))
-            
-            elif {"y", "z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[-1, 0, 0]))
-            elif {"y", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[1, 0, 0]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[1, 0, 0]))
-            elif {"-y", "z"}.issubset(connections):
-                pass  # No need to rotate the elbow
-            elif {"-y", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[1, 0, 0]))
-
-            else:
-                raise ValueError("Invalid connections for elbow")
-
-        # Translation
-        self.apply_translation(mesh=mesh, position=position)
-        return mesh
-
-    def tee_or_three_way_elbow(self, position: Tuple[int, int, int], connections: List[str]) -> trimesh.Trimesh:
-        stripped_connections = set([connection.strip("-") for connection in connections])
-        if not {"x", "y", "z"}.issubset(stripped_connections):  # Tee
-            mesh = self.pipe_meshes[ConnectionTypes.Tee].copy()
-
-            # Rotation (In the origin)
-            if {"x", "-x", "y"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[-1, 0, 0]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-            elif {"x", "-x", "-y"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[1, 0, 0]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-
-            elif {"x", "-x", "z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 0, 1]))
-            elif {"x", "-x", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 0, 1]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-
-            elif {"x", "y", "-y"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-            elif {"-x", "y", "-y"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, -1, 0]))
-
-            elif {"y", "-y", "z"}.issubset(connections):
-                pass  # No need to rotate the tee
-            elif {"y", "-y", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-
-            elif {"x", "z", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[1, 0, 0]))
-            elif {"-x", "z", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, -1, 0]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[1, 0, 0]))
-
-            elif {"y", "z", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[-1, 0, 0]))
-            elif {"-y", "z", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[1, 0, 0]))
-
-            else:
-                raise ValueError("Invalid connections for tee")
-
-        else:  # Three-Way Elbow
-            mesh = self.pipe_meshes[ConnectionTypes.ThreeWayElbow].copy()
-
-            # Rotation (In the origin)
-            if {"x", "y", "z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[-1, 0, 0]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-            elif {"x", "y", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[-1, 0, 0]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-            elif {"x", "-y", "z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-            elif {"x", "-y", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-            elif {"-x", "y", "z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[-1, 0, 0]))
-            elif {"-x", "y", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[-1, 0, 0]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[-1, 0, 0]))
-            elif {"-x", "-y", "z"}.issubset(connections):
-                pass  # No need to rotate the three-way elbow
-            elif {"-x", "-y", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[1, 0, 0]))
-
-            else:
-                raise ValueError("Invalid connections for three way elbow")
-
-        # Translation
-        self.apply_translation(mesh=mesh, position=position)
-        return mesh
+        # Notice: Without the sample method, the points are the vertices of the assembled mesh arrays
+        if use_sample_method is True:
+            sampling_bytes = points_bytes * MEMORY_FACTORS["sampling"]
+        else:
+            sampling_bytes = mesh_bytes * MEMORY_FACTORS["assembly"] + points_bytes - num_of_points * MESH_ITEM_SIZE
 
-    def cross_or_four_way_tee(self, position: Tuple[int, int, int], connections: List[str]) -> trimesh.Trimesh:
-        stripped_connections = set([connection.strip("-") for connection in connections])
-        if not {"x", "y", "z"}.issubset(stripped_connections):  # Cross
-            mesh = self.pipe_meshes[ConnectionTypes.Cross].copy()
+        predicted_memory = {
+            "mesh_assembly": int(held_mesh_bytes * MEMORY_FACTORS["assembly"]),
+            "sampling": held_mesh_bytes + int(sampling_bytes),
+            "mesh_write": held_mesh_bytes + points_bytes + int(export_bytes * MEMORY_FACTORS["export"]),
+            "pcd_write": held_mesh_bytes + points_bytes + int(points_bytes * MEMORY_FACTORS[f"pcd_{data_format}"])
+        }
+        predicted_memory["peak"] = max(predicted_memory.values())
+        return predicted_memory
 
-            # Rotation (In the origin)
-            if {"x", "-x", "y", "-y"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-            elif {"x", "-x", "z", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 0, 1]))
-            elif {"y", "-y", "z", "-z"}.issubset(connections):
-                pass  # No need to rotate the cross
+    def assemble_arrays(self,
+                        positions: np.ndarray,
+                        masks: np.ndarray,
+                        vertex_offset: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Assemble the vertices and faces arrays from the node positions and their (valid) connections masks.
+        The nodes are grouped by oriented part, the translations are broadcast over each part vertices block
+        and the face indices are offset in one pass.
+        :param positions: The (N, 3) node positions.
+        :param masks: The (N,) connections masks.
+        :param vertex_offset: The index of the first vertex (to offset the face indices of a mesh chunk).
+        :return: The combined vertices and faces.
+        """
+        # Group the nodes by their oriented part
+        node_order = np.argsort(masks, kind="stable")
+        group_masks, group_counts = np.unique(masks[node_order], return_counts=True)
+        group_positions = np.split(np.asarray(positions, dtype=np.float64)[node_order], np.cumsum(group_counts)[:-1])
+
+        num_of_vertices, num_of_faces = self.get_mesh_size(masks=masks)
+        combined_vertices = np.empty(shape=(num_of_vertices, 3), dtype=np.float64)
+        combined_faces = np.empty(shape=(num_of_faces, 3), dtype=np.int64)
+
+        vertices_start = 0
+        faces_start = 0
+        for mask, positions_i in zip(group_masks.tolist(), group_positions):
+            vertices, faces = self.oriented_parts[mask]
+            num_of_parts = len(positions_i)
+            vertices_end = vertices_start + len(vertices) * num_of_parts
+            faces_end = faces_start + len(faces) * num_of_parts
+
+            translations = positions_i * self.mesh_scale
+            np.add(
+                vertices[np.newaxis, :, :],
+                translations[:, np.newaxis, :],
+                out=combined_vertices[vertices_start:vertices_end].reshape(num_of_parts, len(vertices), 3)
+            )
+
+            index_offsets = vertex_offset + vertices_start + np.arange(num_of_parts, dtype=np.int64) * len(vertices)
+            np.add(
+                faces[np.newaxis, :, :],
+                index_offsets[:, np.newaxis, np.newaxis],
+                out=combined_faces[faces_start:faces_end].reshape(num_of_parts, len(faces), 3)
+            )
+
+            vertices_start = vertices_end
+            faces_start = faces_end
 
-            else:
-                raise ValueError("Invalid connections for cross")
-
-        else:  # Four-Way Tee
-            mesh = self.pipe_meshes[ConnectionTypes.FourWayTee].copy()
-
-            # Rotation (In the origin)
-            if {"x", "-x", "y", "z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 0, -1]))
-            elif {"x", "-x", "y", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 0, -1]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[-1, 0, 0]))
-            elif {"x", "-x", "-y", "z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 0, 1]))
-            elif {"x", "-x", "-y", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 0, 1]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[1, 0, 0]))
-
-            elif {"x", "y", "-y", "z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-            elif {"x", "y", "-y", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-            elif {"-x", "y", "-y", "z"}.issubset(connections):
-                pass  # No need to rotate the four-way tee
-            elif {"-x", "y", "-y", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, -1, 0]))
-
-            elif {"x", "y", "z", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[-1, 0, 0]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 0, -1]))
-            elif {"x", "-y", "z", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[1, 0, 0]))
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 0, 1]))
-            elif {"-x", "y", "z", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[-1, 0, 0]))
-            elif {"-x", "-y", "z", "-z"}.issubset(connections):
-                mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[1, 0, 0]))
+        if self.mesh_apply_scale != 1.0:
+            combined_vertices *= self.mesh_apply_scale
+        return combined_vertices, combined_faces
 
-            else:
-                raise ValueError("Invalid connections for four way tee")
+    def assemble_mesh(self, positions: np.ndarray, masks: np.ndarray) -> trimesh.Trimesh:
+        combined_vertices, combined_faces = self.assemble_arrays(positions=positions, masks=masks)
+        return trimesh.Trimesh(vertices=combined_vertices, faces=combined_faces, process=False)
 
-        # Translation
-        self.apply_translation(mesh=mesh, position=position)
-        return mesh
+    def iter_mesh_chunks(self,
+                         positions: np.ndarray,
+                         masks: np.ndarray,
+                         chunk_size: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Assemble the mesh in chunks of nodes (the face indices are global).
+        """
+        vertex_offset = 0
+        for chunk_start in range(0, len(masks), chunk_size):
+            chunk_vertices, chunk_faces = self.assemble_arrays(
+                positions=positions[chunk_start:chunk_start + chunk_size],
+                masks=masks[chunk_start:chunk_start + chunk_size],
+                vertex_offset=vertex_offset
+            )
+            vertex_offset += len(chunk_vertices)
+            yield chunk_vertices, chunk_faces
+
+    def sample_surface(self,
+                       positions: np.ndarray,
+                       masks: np.ndarray,
+                       count: int,
+                       seed: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Area-weighted sampling of the mesh surface, without building the mesh.
+        The points are distributed over the nodes by their part area (multinomial), then each oriented part group
+        samples its faces by the kit face area tables and places all its points at once.
+        The node and part type of each point are known from its sampled face, so the labels come with the points.
+        :param positions: The (N, 3) node positions.
+        :param masks: The (N,) (valid) connections masks.
+        :param count: The number of points to sample.
+        :param seed: The seed of the sampling.
+        :return: The (count, 3) points (grouped by oriented part), the (count,) node indices (in the given nodes)
+        and the (count,) connection type indices of the points.
+        """
+        rng = np.random.default_rng(seed)
+        node_areas = self.mask_areas[masks]
+        total_area = node_areas.sum()
+        if count <= 0 or total_area <= 0:
+            return np.empty(shape=(0, 3), dtype=np.float64), np.empty(shape=0, dtype=np.int64), \
+                np.empty(shape=0, dtype=np.uint8)
+        node_counts = rng.multinomial(count, node_areas / total_area)
+
+        # Group the nodes by their oriented part
+        node_order = np.argsort(masks, kind="stable")
+        group_masks, group_counts = np.unique(masks[node_order], return_counts=True)
+        group_node_indices = np.split(node_order, np.cumsum(group_counts)[:-1])
+
+        points = np.empty(shape=(count, 3), dtype=np.float64)
+        point_node_indices = np.empty(shape=count, dtype=np.int64)
+        point_connection_types = np.empty(shape=count, dtype=np.uint8)
+        points_start = 0
+        for mask, node_indices in zip(group_masks.tolist(), group_node_indices):
+            node_counts_i = node_counts[node_indices]
+            num_of_points = int(node_counts_i.sum())
+            if num_of_points == 0:
+                continue
+            points_end = points_start + num_of_points
+
+            # Pick the faces by area, and a uniform point in each face (the barycentric coordinates are folded)
+            vertices, faces = self.oriented_parts[mask]
+            face_area_cumsum = self.part_face_area_cumsums[self.mask_connection_types[mask]]
+            face_indices = np.searchsorted(face_area_cumsum, rng.random(num_of_points) * face_area_cumsum[-1],
+                                           side="right")
+            np.minimum(face_indices, len(faces) - 1, out=face_indices)
+            barycentric = rng.random(size=(num_of_points, 2))
+            folded = barycentric.sum(axis=1) > 1.0
+            barycentric[folded] = 1.0 - barycentric[folded]
+
+            triangles = vertices[faces[face_indices]]
+            translations = np.repeat(np.asarray(positions, dtype=np.float64)[node_indices] * self.mesh_scale,
+                                     node_counts_i, axis=0)
+            points_i = points[points_start:points_end]
+            np.add(triangles[:, 0], translations, out=points_i)
+            points_i += barycentric[:, :1] * (triangles[:, 1] - triangles[:, 0])
+            points_i += barycentric[:, 1:] * (triangles[:, 2] - triangles[:, 0])
+            point_node_indices[points_start:points_end] = np.repeat(node_indices, node_counts_i)
+            point_connection_types[points_start:points_end] = self.mask_connection_types[mask]
+            points_start = points_end
 
-    def five_way_tee(self, position: Tuple[int, int, int], connections: List[str]) -> trimesh.Trimesh:
-        mesh = self.pipe_meshes[ConnectionTypes.FiveWayTee].copy()
+        if self.mesh_apply_scale != 1.0:
+            points *= self.mesh_apply_scale
+        return points, point_node_indices, point_connection_types
 
-        # Rotation (In the origin)
-        if {"x", "-x", "y", "-y", "z"}.issubset(connections):
-            pass  # No need to rotate the five-way tee
-        elif {"x", "-x", "y", "-y", "-z"}.issubset(connections):
-            mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[1, 0, 0]))
-            mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[1, 0, 0]))
+    def get_vertex_labels(self, masks: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The node indices and connection type indices of the vertices of assemble_arrays (in the same order).
+        """
+        node_order = np.argsort(masks, kind="stable")
+        vertex_counts = np.array([len(self.oriented_parts[mask][0]) for mask in masks[node_order].tolist()],
+                                 dtype=np.int64)
+        vertex_node_indices = np.repeat(node_order, vertex_counts)
+        vertex_connection_types = self.mask_connection_types[masks[vertex_node_indices]].astype(np.uint8)
+        return vertex_node_indices, vertex_connection_types
+
+    def get_graph_arrays(self, graph: "nx.Graph") -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        The positions, connections masks and indices (in the graph nodes order) of the nodes with valid connections.
+        """
+        position_dict = nx.get_node_attributes(graph, "position")
+        connections_dict = nx.get_node_attributes(graph, "connections")
+        node_ids = list(position_dict.keys())
 
-        elif {"x", "-x", "y", "z", "-z"}.issubset(connections):
-            mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[-1, 0, 0]))
-        elif {"x", "-x", "-y", "z", "-z"}.issubset(connections):
-            mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[1, 0, 0]))
+        positions = np.array([position_dict[node_i] for node_i in node_ids], dtype=np.float64).reshape(-1, 3)
+        masks = self.get_connections_masks(connections_list=[connections_dict[node_i] for node_i in node_ids])
+        valid_nodes = self.classify_connections(masks=masks, node_ids=node_ids) >= 0
+        return positions[valid_nodes], masks[valid_nodes], np.flatnonzero(valid_nodes)
 
-        elif {"x", "y", "-y", "z", "-z"}.issubset(connections):
-            mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, 1, 0]))
-        elif {"-x", "y", "-y", "z", "-z"}.issubset(connections):
-            mesh.apply_transform(trimesh.transformations.rotation_matrix(angle=np.pi / 2, direction=[0, -1, 0]))
+    def get_pipe_graph_arrays(self, pipe_graph: PipeGraph) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        The positions, connections masks and indices of the pipe graph nodes with valid connections.
+        """
+        masks = pipe_graph.opened_masks
+        valid_nodes = self.classify_connections(masks=masks, node_ids=pipe_graph.node_ids) >= 0
+        return pipe_graph.positions.astype(np.float64)[valid_nodes], masks[valid_nodes], np.flatnonzero(valid_nodes)
 
+    def get_input_arrays(self, graph: Union["nx.Graph", PipeGraph]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        The positions, connections masks and indices of the valid nodes of a PipeGraph (or a networkx graph).
+        """
+        if isinstance(graph, PipeGraph):
+            return self.get_pipe_graph_arrays(pipe_graph=graph)
+        elif nx is not None and isinstance(graph, nx.Graph):
+            return self.get_graph_arrays(graph=graph)
         else:
-            raise ValueError("Invalid connections for five way tee")
-
-        # Translation
-        self.apply_translation(mesh=mesh, position=position)
-        return mesh
-
-    def hexagonal(self, position: Tuple[int, int, int], connections: List[str]) -> trimesh.Trimesh:
-        mesh = self.pipe_meshes[ConnectionTypes.Hexagonal].copy()
+            raise ValueError("Invalid input graph")
 
-        if not {"x", "-x", "y", "-y", "z", "-z"}.issubset(connections):
-            raise ValueError("Invalid connections for hexagonal")
-
-        # Translation (No need to rotate the hexagonal)
-        self.apply_translation(mesh=mesh, position=position)
-        return mesh
-
-    def build_mesh(self, graph: nx.Graph, output_filepath=None, output_only: bool = False) -> trimesh.Trimesh:
+    def export_mesh_streaming(self,
+                              graph: Union["nx.Graph", PipeGraph],
+                              output_filepath: str,
+                              chunk_size: int = 256,
+                              output_fp: Optional[BinaryIO] = None):
+        """
+        Write the mesh of the graph straight to an obj or ply file, in fixed-size chunks of nodes.
+        The memory use depends on the chunk size only (not on the size of the graph).
+        """
+        positions, masks, _ = self.get_input_arrays(graph=graph)
+        num_of_vertices, num_of_faces = self.get_mesh_size(masks=masks)
+
+        writer = StreamingMeshWriter(filepath=output_filepath)
+        writer.write(
+            mesh_chunks_factory=lambda: self.iter_mesh_chunks(positions=positions, masks=masks, chunk_size=chunk_size),
+            num_of_vertices=num_of_vertices,
+            num_of_faces=num_of_faces,
+            fp=output_fp
+        )
+
+    def export_mesh_instanced(self,
+                              graph: Union["nx.Graph", PipeGraph],
+                              output_filepath: str,
+                              gpu_instancing: bool = True,
+                              output_fp: Optional[BinaryIO] = None):
+        """
+        Write the mesh of the graph as a glb scene: each oriented part mesh once, and a translation per node.
+        """
+        positions, masks, _ = self.get_input_arrays(graph=graph)
+
+        # Group the nodes by their oriented part
+        node_order = np.argsort(masks, kind="stable")
+        group_masks, group_counts = np.unique(masks[node_order], return_counts=True)
+        group_positions = np.split(positions[node_order], np.cumsum(group_counts)[:-1])
+
+        part_meshes = []
+        translations = []
+        for mask, positions_i in zip(group_masks.tolist(), group_positions):
+            vertices, faces = self.oriented_parts[mask]
+            normals = self.part_kit.variant_arrays[mask]["normals"]
+            part_meshes.append((vertices * self.mesh_apply_scale, normals, faces))
+            translations.append(positions_i * (self.mesh_scale * self.mesh_apply_scale))
+
+        writer = InstancedMeshWriter(filepath=output_filepath, gpu_instancing=gpu_instancing)
+        writer.write(part_meshes=part_meshes, translations=translations, fp=output_fp)
+
+    def build_mesh(self,
+                   graph: Union["nx.Graph", PipeGraph],
+                   output_filepath=None,
+                   output_only: bool = False,
+                   streaming: bool = False,
+                   streaming_chunk_size: int = 256,
+                   instanced: bool = False,
+                   gpu_instancing: bool = True,
+                   output_fp: Optional[BinaryIO] = None) -> Optional[trimesh.Trimesh]:
         """
         Convert the graph to a mesh and save it to a file.
         Supported formats are stl, off, ply, collada, json, dict, glb, dict64, msgpack.
-        :param graph:
+        :param graph: A PipeGraph (or a networkx graph).
         :param output_filepath:
         :param output_only:
+        :param streaming: Write the mesh to the output file (obj or ply) in chunks, without building it (returns None).
+        The streamed files have the vertices and faces only, without vertex normals (the same mesh as the built one,
+        with the vertices in another order).
+        :param streaming_chunk_size: The number of nodes in each written chunk.
+        :param instanced: Write the mesh to the output file (glb) as instanced parts without building it (returns None).
+        :param gpu_instancing: Use the EXT_mesh_gpu_instancing extension for the instances (or plain scene nodes).
+        :param output_fp: A binary file object to write the output file to in streaming and instanced modes (e.g. an
+        in-memory file), the format is still set by the output file path suffix.
         :return:
         """
-        position_dict = nx.get_node_attributes(graph, "position")
-        connections_dict = nx.get_node_attributes(graph, "connections")
-
-        mesh_list = []
-        for node_i in list(position_dict.keys()):
-            position_i = position_dict[node_i]
-            connections_i = connections_dict[node_i]
-            num_of_connections = len(connections_i)
-
-            if num_of_connections not in self.connections_cases:
-                print("Invalid number of connections")
-            else:
-                mesh = self.connections_cases[num_of_connections](
-                    position=position_i,
-                    connections=connections_i
-                )
-                mesh_list.append(mesh)
-
-        combined_mesh: trimesh.Trimesh = trimesh.util.concatenate(mesh_list)
-        if self.mesh_apply_scale != 1.0:
-            combined_mesh.apply_scale(self.mesh_apply_scale)
+        if instanced is True:
+            if output_filepath is None:
+                raise ValueError("Instanced mode requires an output file path")
+            self.export_mesh_instanced(graph=graph, output_filepath=output_filepath, gpu_instancing=gpu_instancing,
+                                       output_fp=output_fp)
+            return None
+
+        if streaming is True:
+            if output_filepath is None:
+                raise ValueError("Streaming mode requires an output file path")
+            self.export_mesh_streaming(graph=graph, output_filepath=output_filepath, chunk_size=streaming_chunk_size,
+                                       output_fp=output_fp)
+            return None
+
+        positions, masks, _ = self.get_input_arrays(graph=graph)
+        combined_mesh = self.assemble_mesh(positions=positions, masks=masks)
         if output_only is False:
             if output_filepath is not None:
-                combined_mesh.export(file_obj=output_filepath)
+                # Notice: The obj files are written without vertex normals, like the streamed obj files
+                export_kwargs = {"include_normals": False} if str(output_filepath).lower().endswith(".obj") else {}
+                combined_mesh.export(file_obj=output_filepath, **export_kwargs)
             else:
                 combined_mesh.show()
         return combined_mesh
 
-    def build_pcd(self, input_object: Union[nx.Graph, trimesh.Trimesh],
-                  use_sample_method: bool = True,
-                  points_to_sample: Union[float, int] = 1.0,
-                  output_filepath=None,
-                  output_only: bool = False) -> o3d.geometry.PointCloud:
-        if isinstance(input_object, nx.Graph):
-            mesh = self.build_mesh(graph=input_object, output_only=True)
-        elif isinstance(input_object, trimesh.Trimesh):
+    def sample_pcd(self, input_object: Union["nx.Graph", PipeGraph, trimesh.Trimesh],
+                   use_sample_method: bool = True,
+                   points_to_sample: Union[float, int] = 1.0,
+                   seed: Optional[int] = None,
+                   labels: bool = False) -> Tuple[np.ndarray, Optional[Dict[str, np.ndarray]]]:
+        """
+        Convert the graph (or the mesh) to point cloud arrays (see build_pcd).
+        :return: The (N, 3) points, and the "node" and "part" (N,) point labels (None if labels is False).
+        """
+        if isinstance(input_object, trimesh.Trimesh):
+            if labels is True:
+                raise ValueError("Point labels require a graph input object")
             mesh = input_object
+            num_of_vertices = len(mesh.vertices)
         else:
-            raise ValueError("Invalid input object")
+            mesh = None
+            positions, masks, node_indices = self.get_input_arrays(graph=input_object)
+            num_of_vertices, _ = self.get_mesh_size(masks=masks)
 
+        point_node_indices = None
+        point_connection_types = None
         if use_sample_method is True:
-            # If float, sample the percentage of the points
-            if isinstance(points_to_sample, float):
-                percentage = points_to_sample
-                count = int(len(mesh.vertices) * percentage)
-            # If int, sample the number of points
+            count = self.get_num_of_points(num_of_vertices=num_of_vertices, points_to_sample=points_to_sample)
+            if mesh is not None:
+                points = mesh.sample(count=count, seed=seed)
             else:
-                count = points_to_sample
-            points = mesh.sample(count=count)
+                points, point_node_indices, point_connection_types = self.sample_surface(
+                    positions=positions,
+                    masks=masks,
+                    count=count,
+                    seed=seed
+                )
         else:
-            points = mesh.vertices
+            if mesh is not None:
+                points = np.asarray(mesh.vertices)
+            else:
+                points, _ = self.assemble_arrays(positions=positions, masks=masks)
+                if labels is True:
+                    point_node_indices, point_connection_types = self.get_vertex_labels(masks=masks)
+
+        point_labels = None
+        if labels is True:
+            point_labels = {
+                "node": node_indices[point_node_indices].astype(np.uint32),
+                "part": point_connection_types
+            }
+        return points, point_labels
+
+    def build_pcd(self, input_object: Union["nx.Graph", PipeGraph, trimesh.Trimesh],
+                  use_sample_method: bool = True,
+                  points_to_sample: Union[float, int] = 1.0,
+                  output_filepath=None,
+                  output_only: bool = False,
+                  seed: Optional[int] = None,
+                  data_format: str = "binary",
+                  labels: bool = False) -> np.ndarray:
+        """
+        Convert the graph (or the mesh) to a point cloud and save it to a file.
+        Supported formats are pcd (ascii, binary, binary_compressed) and ply (ascii, binary).
+        A graph is sampled straight from the kit face area tables (the mesh is never built).
+        :param input_object:
+        :param use_sample_method:
+        :param points_to_sample:
+        :param output_filepath:
+        :param output_only:
+        :param seed: The seed of the surface sampling.
+        :param data_format: The data format of the output file.
+        :param labels: Write the "node" (index in the graph nodes) and "part" (ConnectionTypes index) label fields of
+        each point to the output file (graph inputs only).
+        :return: The (N, 3) points.
+        """
+        points, point_labels = self.sample_pcd(
+            input_object=input_object,
+            use_sample_method=use_sample_method,
+            points_to_sample=points_to_sample,
+            seed=seed,
+            labels=labels
+        )
 
-        pcd = o3d.geometry.PointCloud()
-        pcd.points = o3d.utility.Vector3dVector(points)
         if output_only is False:
             if output_filepath is not None:
-                o3d.io.write_point_cloud(filename=output_filepath, pointcloud=pcd, write_ascii=True)
+                writer = PointCloudWriter(filepath=output_filepath, data_format=data_format)
+                writer.write(points=points, fields=point_labels)
             else:
+                # Notice: Open3D is only required to visualize the point cloud
+                import open3d as o3d
+
+                pcd = o3d.geometry.PointCloud()
+                pcd.points = o3d.utility.Vector3dVector(points)
                 o3d.visualization.draw_geometries([pcd], window_name="Point Cloud Viewer")
-        return pcd
+        return points
 
 
 ########
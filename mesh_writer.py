@@ -0,0 +1,204 @@
+import json
+import pathlib
+import numpy as np
+from typing import BinaryIO, Callable, Iterator, Tuple, List, Optional
+
+
+# A callable that yields the mesh (vertices, faces) chunks, the face indices are global (0-based)
+MeshChunksFactory = Callable[[], Iterator[Tuple[np.ndarray, np.ndarray]]]
+
+
+class StreamingMeshWriter:
+    def __init__(self, filepath: str):
+        """
+        Write a mesh chunk by chunk, without ever materializing the whole mesh in memory.
+        Supported formats are obj (ascii) and ply (binary little endian).
+        Only the vertices and faces are written (no vertex normals, like the obj files of the built meshes).
+        :param filepath: The output file path (the format is set by its suffix).
+        """
+        self.filepath = filepath
+        self.file_type = pathlib.Path(filepath).suffix.lower().lstrip(".")
+        if self.file_type not in ["obj", "ply"]:
+            raise ValueError(f"Unsupported streaming mesh format: {self.file_type}")
+
+    def write(self,
+              mesh_chunks_factory: MeshChunksFactory,
+              num_of_vertices: int,
+              num_of_faces: int,
+              fp: Optional[BinaryIO] = None):
+        """
+        :param mesh_chunks_factory: The mesh chunks factory.
+        :param num_of_vertices: The number of vertices of the mesh.
+        :param num_of_faces: The number of faces of the mesh.
+        :param fp: A binary file object to write to (instead of the output file path, e.g. an in-memory file).
+        """
+        if fp is None:
+            with open(self.filepath, "wb") as fp:
+                return self.write(mesh_chunks_factory=mesh_chunks_factory, num_of_vertices=num_of_vertices,
+                                  num_of_faces=num_of_faces, fp=fp)
+
+        if self.file_type == "obj":
+            self.write_obj(mesh_chunks_factory=mesh_chunks_factory, fp=fp)
+        else:
+            self.write_ply(mesh_chunks_factory=mesh_chunks_factory, num_of_vertices=num_of_vertices,
+                           num_of_faces=num_of_faces, fp=fp)
+
+    @staticmethod
+    def write_obj(mesh_chunks_factory: MeshChunksFactory, fp: BinaryIO):
+        # Notice: OBJ faces may reference any previously written vertex, so each chunk is written as is
+        for vertices, faces in mesh_chunks_factory():
+            fp.write((("v %.8f %.8f %.8f\n" * len(vertices)) % tuple(vertices.ravel().tolist())).encode("ascii"))
+            fp.write((("f %d %d %d\n" * len(faces)) % tuple((faces + 1).ravel().tolist())).encode("ascii"))
+
+    @staticmethod
+    def write_ply(mesh_chunks_factory: MeshChunksFactory, num_of_vertices: int, num_of_faces: int, fp: BinaryIO):
+        header = (
+            "ply\n"
+            "format binary_little_endian 1.0\n"
+            f"element vertex {num_of_vertices}\n"
+            "property float x\n"
+            "property float y\n"
+            "property float z\n"
+            f"element face {num_of_faces}\n"
+            "property list uchar int vertex_indices\n"
+            "end_header\n"
+        )
+        face_dtype = np.dtype([("count", "u1"), ("indices", "<i4", (3,))])
+
+        # Notice: PLY stores all the vertices before the faces, so the chunks are iterated twice
+        fp.write(header.encode("ascii"))
+        for vertices, _ in mesh_chunks_factory():
+            fp.write(vertices.astype("<f4").tobytes())
+        for _, faces in mesh_chunks_factory():
+            face_records = np.empty(shape=len(faces), dtype=face_dtype)
+            face_records["count"] = 3
+            face_records["indices"] = faces
+            fp.write(face_records.tobytes())
+
+
+# glTF constants
+GLB_MAGIC = 0x46546C67  # "glTF"
+GLB_VERSION = 2
+GLB_CHUNK_JSON = 0x4E4F534A  # "JSON"
+GLB_CHUNK_BIN = 0x004E4942  # "BIN\0"
+GLTF_FLOAT = 5126
+GLTF_UNSIGNED_INT = 5125
+GLTF_ARRAY_BUFFER = 34962
+GLTF_ELEMENT_ARRAY_BUFFER = 34963
+GLTF_GPU_INSTANCING_EXTENSION = "EXT_mesh_gpu_instancing"
+
+
+class InstancedMeshWriter:
+    def __init__(self, filepath: str, gpu_instancing: bool = True):
+        """
+        Write a scene of shared part meshes and their per-node instances, as a binary glTF (glb) file.
+        Each part mesh is stored once, so the file size depends on the number of nodes times a translation only.
+        :param filepath: The output file path (glb).
+        :param gpu_instancing: Store the instances of each part as an EXT_mesh_gpu_instancing translations accessor,
+        or (if False) as plain scene nodes that share the part mesh (for viewers without the extension).
+        """
+        self.filepath = filepath
+        self.file_type = pathlib.Path(filepath).suffix.lower().lstrip(".")
+        if self.file_type != "glb":
+            raise ValueError(f"Unsupported instanced mesh format: {self.file_type}")
+        self.gpu_instancing = gpu_instancing
+
+    def write(self,
+              part_meshes: List[Tuple[np.ndarray, np.ndarray, np.ndarray]],
+              translations: List[np.ndarray],
+              fp: Optional[BinaryIO] = None):
+        """
+        :param part_meshes: The (vertices, normals, faces) arrays of each part mesh.
+        :param translations: The (K, 3) instance translations of each part mesh.
+        :param fp: A binary file object to write to (instead of the output file path, e.g. an in-memory file).
+        """
+        if fp is None:
+            with open(self.filepath, "wb") as fp:
+                return self.write(part_meshes=part_meshes, translations=translations, fp=fp)
+
+        buffer_chunks = []
+        buffer_length = 0
+        buffer_views = []
+        accessors = []
+
+        def add_accessor(array: np.ndarray, accessor_type: str, target: Optional[int] = None,
+                         with_bounds: bool = False) -> int:
+            nonlocal buffer_length
+            array_bytes = array.tobytes()
+            buffer_view = {"buffer": 0, "byteOffset": buffer_length, "byteLength": len(array_bytes)}
+            if target is not None:
+                buffer_view["target"] = target
+            buffer_views.append(buffer_view)
+            buffer_chunks.append(array_bytes)
+            buffer_length += len(array_bytes)
+
+            accessor = {
+                "bufferView": len(buffer_views) - 1,
+                "componentType": GLTF_UNSIGNED_INT if array.dtype == np.uint32 else GLTF_FLOAT,
+                "count": len(array),
+                "type": accessor_type
+            }
+            if with_bounds:
+                accessor["min"] = array.min(axis=0).tolist()
+                accessor["max"] = array.max(axis=0).tolist()
+            accessors.append(accessor)
+            return len(accessors) - 1
+
+        meshes = []
+        nodes = []
+        for (vertices, normals, faces), translations_i in zip(part_meshes, translations):
+            if len(translations_i) == 0:
+                continue
+
+            # Notice: All the accessors are 4-byte types, so the buffer views stay aligned
+            position_accessor = add_accessor(np.ascontiguousarray(vertices, dtype="<f4"), "VEC3",
+                                             target=GLTF_ARRAY_BUFFER, with_bounds=True)
+            normal_accessor = add_accessor(np.ascontiguousarray(normals, dtype="<f4"), "VEC3",
+                                           target=GLTF_ARRAY_BUFFER)
+            indices_accessor = add_accessor(np.ascontiguousarray(faces, dtype="<u4").reshape(-1), "SCALAR",
+                                            target=GLTF_ELEMENT_ARRAY_BUFFER)
+            meshes.append({
+                "primitives": [{
+                    "attributes": {"POSITION": position_accessor, "NORMAL": normal_accessor},
+                    "indices": indices_accessor
+                }]
+            })
+            mesh_idx = len(meshes) - 1
+
+            translations_i = np.ascontiguousarray(translations_i, dtype="<f4").reshape(-1, 3)
+            if self.gpu_instancing is True:
+                translation_accessor = add_accessor(translations_i, "VEC3")
+                nodes.append({
+                    "mesh": mesh_idx,
+                    "extensions": {GLTF_GPU_INSTANCING_EXTENSION: {"attributes": {"TRANSLATION": translation_accessor}}}
+                })
+            else:
+                nodes.extend({"mesh": mesh_idx, "translation": translation} for translation in translations_i.tolist())
+
+        gltf = {
+            "asset": {"version": "2.0", "generator": "PipeForge3D"},
+            "scene": 0,
+            "scenes": [{"nodes": list(range(len(nodes)))}],
+            "nodes": nodes,
+            "meshes": meshes,
+            "accessors": accessors,
+            "bufferViews": buffer_views,
+            "buffers": [{"byteLength": buffer_length}]
+        }
+        if self.gpu_instancing is True:
+            gltf["extensionsUsed"] = [GLTF_GPU_INSTANCING_EXTENSION]
+            gltf["extensionsRequired"] = [GLTF_GPU_INSTANCING_EXTENSION]
+
+        # Both chunks are padded to 4 bytes (the json chunk with spaces, the binary chunk with zeros)
+        json_bytes = json.dumps(gltf, separators=(",", ":")).encode("utf-8")
+        json_bytes += b" " * (-len(json_bytes) % 4)
+        bin_padding = b"\x00" * (-buffer_length % 4)
+        total_length = 12 + 8 + len(json_bytes) + 8 + buffer_length + len(bin_padding)
+
+        fp.write(np.array([GLB_MAGIC, GLB_VERSION, total_length], dtype="<u4").tobytes())
+        fp.write(np.array([len(json_bytes), GLB_CHUNK_JSON], dtype="<u4").tobytes())
+        fp.write(json_bytes)
+        fp.write(np.array([buffer_length + len(bin_padding), GLB_CHUNK_BIN], dtype="<u4").tobytes())
+        for buffer_chunk in buffer_chunks:
+            fp.write(buffer_chunk)
+        fp.write(bin_padding)
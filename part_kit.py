@@ -0,0 +1,260 @@
+from enum import Enum
+import hashlib
+import json
+import os
+import numpy as np
+import trimesh
+from typing import Tuple, Optional, Dict, BinaryIO
+
+
+class ConnectionTypes(Enum):
+    Cap = "Cap.obj"
+    Coupler = "Coupler.obj"
+    Elbow = "Elbow.obj"
+    Tee = "Tee.obj"
+    ThreeWayElbow = "ThreeWayElbow.obj"
+    Cross = "Cross.obj"
+    FourWayTee = "FourWayTee.obj"
+    FiveWayTee = "FiveWayTee.obj"
+    Hexagonal = "Hexagonal.obj"
+
+
+# Notice: Bump the version when the pack layout or the orientation of the parts changes (the packs of other versions
+# are recompiled on load, the kit hash only depends on the source mesh files)
+KIT_PACK_VERSION = 3
+KIT_PACK_FILENAME = "kit.pack"
+KIT_PACK_MAGIC = b"PF3DPACK"
+KIT_PACK_ALIGNMENT = 64
+
+
+###################
+# Array pack file #
+###################
+def write_array_pack(filepath: str, header: dict, arrays: dict, fp: Optional[BinaryIO] = None):
+    """
+    Write a binary pack file: magic, header length, json header and the raw arrays (aligned for memory mapping).
+    The file is written to a temporary path and renamed, so concurrent readers never see a partial pack.
+    :param filepath: The output pack file path.
+    :param header: A json serializable header.
+    :param arrays: A dictionary of array name -> numpy array.
+    :param fp: An empty binary file object to write the pack to (instead of the output file path, e.g. an in-memory
+    file).
+    """
+    arrays_info = {}
+    offset = 0
+    for array_name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        arrays_info[array_name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += -(-array.nbytes // KIT_PACK_ALIGNMENT) * KIT_PACK_ALIGNMENT
+
+    header = dict(header, arrays=arrays_info)
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = len(KIT_PACK_MAGIC) + 8 + len(header_bytes)
+    data_start = -(-data_start // KIT_PACK_ALIGNMENT) * KIT_PACK_ALIGNMENT
+
+    if fp is None:
+        tmp_filepath = f"{filepath}.{os.getpid()}.tmp"
+        with open(tmp_filepath, "wb") as fp:
+            write_array_pack(filepath=filepath, header=header, arrays=arrays, fp=fp)
+        os.replace(tmp_filepath, filepath)
+        return
+
+    # Notice: The alignment gaps are written as zeros (the file object may not support seeking past its end)
+    fp.write(KIT_PACK_MAGIC)
+    fp.write(np.uint64(len(header_bytes)).tobytes())
+    fp.write(header_bytes)
+    position = len(KIT_PACK_MAGIC) + 8 + len(header_bytes)
+    for array_name, array in arrays.items():
+        array_bytes = np.ascontiguousarray(array).tobytes()
+        fp.write(bytes(data_start + arrays_info[array_name]["offset"] - position))
+        fp.write(array_bytes)
+        position = data_start + arrays_info[array_name]["offset"] + len(array_bytes)
+    fp.write(bytes(data_start + offset - position))
+
+
+def read_array_pack(filepath: str) -> Tuple[dict, dict]:
+    """
+    Memory map a binary pack file written by write_array_pack.
+    :param filepath: The pack file path.
+    :return: The json header and a dictionary of array name -> read-only numpy array (backed by the mapped pages).
+    """
+    with open(filepath, "rb") as fp:
+        magic = fp.read(len(KIT_PACK_MAGIC))
+        if magic != KIT_PACK_MAGIC:
+            raise ValueError(f"Invalid pack file: {filepath}")
+        header_length = int(np.frombuffer(fp.read(8), dtype=np.uint64)[0])
+        header = json.loads(fp.read(header_length).decode("utf-8"))
+
+    data_start = len(KIT_PACK_MAGIC) + 8 + header_length
+    data_start = -(-data_start // KIT_PACK_ALIGNMENT) * KIT_PACK_ALIGNMENT
+
+    arrays = {}
+    if header["arrays"]:
+        buffer = np.memmap(filepath, dtype=np.uint8, mode="r")
+        for array_name, array_info in header["arrays"].items():
+            dtype = np.dtype(array_info["dtype"])
+            shape = tuple(array_info["shape"])
+            start = data_start + array_info["offset"]
+            end = start + int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+            arrays[array_name] = buffer[start:end].view(dtype).reshape(shape)
+    return header, arrays
+
+
+############
+# Part Kit #
+############
+class PartKit:
+    def __init__(self,
+                 kit_hash: str,
+                 part_arrays: dict[ConnectionTypes, dict[str, np.ndarray]],
+                 variant_parts: dict[int, ConnectionTypes],
+                 variant_arrays: dict[int, dict[str, np.ndarray]]):
+        """
+        The connection types meshes and their pre-rotated (per orientation) variants.
+        :param kit_hash: The content hash of the source mesh files.
+        :param part_arrays: A dictionary of connection type -> {"vertices", "faces", "normals", "face_areas"} arrays
+        (the face areas of a part are shared by all its variants, a rotation doesn't change them).
+        :param variant_parts: A dictionary of connections mask -> connection type of the variant.
+        :param variant_arrays: A dictionary of connections mask -> {"vertices", "normals"} arrays (faces are shared).
+        """
+        self.kit_hash = kit_hash
+        self.part_arrays = part_arrays
+        self.variant_parts = variant_parts
+        self.variant_arrays = variant_arrays
+
+    @staticmethod
+    def get_kit_hashes(mesh_dir: str) -> Tuple[str, Dict[str, str]]:
+        """
+        Hash the source mesh files (each file is read once).
+        Notice: The pack layout version is not part of the hash, it is checked separately in the pack header (see load).
+        :return: The content hash of the kit (the connection type names and the OBJ bytes), and the content hash of
+        each source mesh file (to tell which files differ between two kits).
+        """
+        kit_hash = hashlib.sha256()
+        kit_file_hashes = {}
+        for connection_type in ConnectionTypes:
+            with open(os.path.join(mesh_dir, connection_type.value), "rb") as fp:
+                data = fp.read()
+            kit_hash.update(connection_type.value.encode("utf-8"))
+            kit_hash.update(data)
+            kit_file_hashes[connection_type.value] = hashlib.sha256(data).hexdigest()
+        return kit_hash.hexdigest(), kit_file_hashes
+
+    @staticmethod
+    def load_part_meshes(mesh_dir: str) -> dict[ConnectionTypes, trimesh.Trimesh]:
+        part_meshes = {}
+        for connection_type in ConnectionTypes:
+            part_mesh_path = os.path.join(mesh_dir, connection_type.value)
+            part_meshes[connection_type] = trimesh.load(file_obj=part_mesh_path)
+        return part_meshes
+
+    def get_variant(self, mask: int) -> Tuple[np.ndarray, np.ndarray]:
+        vertices = self.variant_arrays[mask]["vertices"]
+        faces = self.part_arrays[self.variant_parts[mask]]["faces"]
+        return vertices, faces
+
+    @classmethod
+    def from_meshes(cls,
+                    kit_hash: str,
+                    part_meshes: dict[ConnectionTypes, trimesh.Trimesh],
+                    variant_meshes: dict[int, Tuple[ConnectionTypes, trimesh.Trimesh]]):
+        part_arrays = {}
+        for connection_type, mesh in part_meshes.items():
+            part_arrays[connection_type] = {
+                "vertices": np.array(mesh.vertices, dtype=np.float64),
+                "faces": np.array(mesh.faces, dtype=np.int64),
+                "normals": np.array(mesh.vertex_normals, dtype=np.float64),
+                "face_areas": np.array(mesh.area_faces, dtype=np.float64)
+            }
+
+        variant_parts = {}
+        variant_arrays = {}
+        for mask, (connection_type, mesh) in variant_meshes.items():
+            variant_parts[mask] = connection_type
+            variant_arrays[mask] = {
+                "vertices": np.array(mesh.vertices, dtype=np.float64),
+                "normals": np.array(mesh.vertex_normals, dtype=np.float64)
+            }
+
+        # Notice: The kit arrays are shared by all the built meshes (and all the processes mapping the pack)
+        for arrays in list(part_arrays.values()) + list(variant_arrays.values()):
+            for array in arrays.values():
+                array.setflags(write=False)
+        return cls(kit_hash=kit_hash, part_arrays=part_arrays, variant_parts=variant_parts,
+                   variant_arrays=variant_arrays)
+
+    def save(self, filepath: str):
+        arrays = {}
+        for connection_type, part_arrays in self.part_arrays.items():
+            for array_name, array in part_arrays.items():
+                arrays[f"parts/{connection_type.name}/{array_name}"] = array
+
+        variants = []
+        for variant_idx, (mask, variant_arrays) in enumerate(self.variant_arrays.items()):
+            variants.append({"mask": mask, "part": self.variant_parts[mask].name})
+            for array_name, array in variant_arrays.items():
+                arrays[f"variants/{variant_idx}/{array_name}"] = array
+
+        header = {
+            "version": KIT_PACK_VERSION,
+            "kit_hash": self.kit_hash,
+            "parts": [connection_type.name for connection_type in self.part_arrays.keys()],
+            "variants": variants
+        }
+        write_array_pack(filepath=filepath, header=header, arrays=arrays)
+
+    @classmethod
+    def load(cls, filepath: str, kit_hash: Optional[str] = None):
+        """
+        Load a part kit pack file (memory mapped).
+        :param filepath: The pack file path.
+        :param kit_hash: The expected content hash of the source mesh files (None to skip the check).
+        :return: The part kit, or None if the pack file is missing or stale.
+        """
+        if not os.path.isfile(filepath):
+            return None
+
+        try:
+            header, arrays = read_array_pack(filepath=filepath)
+        except ValueError:
+            return None
+        if header.get("version") != KIT_PACK_VERSION:
+            return None
+        if kit_hash is not None and header.get("kit_hash") != kit_hash:
+            return None
+
+        part_arrays = {}
+        for part_name in header["parts"]:
+            part_arrays[ConnectionTypes[part_name]] = {
+                array_name: arrays[f"parts/{part_name}/{array_name}"]
+                for array_name in ["vertices", "faces", "normals", "face_areas"]
+            }
+
+        variant_parts = {}
+        variant_arrays = {}
+        for variant_idx, variant in enumerate(header["variants"]):
+            mask = variant["mask"]
+            variant_parts[mask] = ConnectionTypes[variant["part"]]
+            variant_arrays[mask] = {
+                array_name: arrays[f"variants/{variant_idx}/{array_name}"]
+                for array_name in ["vertices", "normals"]
+            }
+
+        return cls(kit_hash=header["kit_hash"], part_arrays=part_arrays, variant_parts=variant_parts,
+                   variant_arrays=variant_arrays)
+
+
+def main():
+    from mesh_builder import MeshBuilder
+
+    # Kit Parameters
+    mesh_dir = "connection_types"
+
+    # Notice: Compile the kit pack even if an up-to-date pack already exists
+    mb = MeshBuilder(mesh_dir=mesh_dir, mesh_scale=1)
+    mb.compile_part_kit()
+    print(f"Compiled: {mb.part_kit_filepath} ({mb.part_kit.kit_hash})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+import pathlib
+import numpy as np
+from typing import BinaryIO, Dict, Optional
+
+# Notice: python-lzf is optional (it is only required for the binary_compressed PCD format)
+try:
+    import lzf
+except ImportError:
+    lzf = None
+
+
+PCD_DATA_FORMATS = ["ascii", "binary", "binary_compressed"]
+PLY_DATA_FORMATS = ["ascii", "binary"]
+
+
+def lzf_compress(data: bytes) -> bytes:
+    """
+    Compress the data with LZF (as required by the binary_compressed PCD format).
+    Data that LZF can't compress is encoded as LZF literal runs (a valid stream of about the size of the data).
+    """
+    if lzf is None:
+        raise ImportError("The binary_compressed data format requires the lzf package (pip install python-lzf)")
+    if len(data) > 0:
+        compressed_data = lzf.compress(data)
+        if compressed_data is not None:
+            return compressed_data
+
+    # Literal runs: a control byte (run length - 1) followed by up to 32 bytes
+    data = np.frombuffer(data, dtype=np.uint8)
+    num_of_full_runs, tail_length = divmod(len(data), 32)
+    full_runs = np.empty(shape=(num_of_full_runs, 33), dtype=np.uint8)
+    full_runs[:, 0] = 31
+    full_runs[:, 1:] = data[:num_of_full_runs * 32].reshape(-1, 32)
+    encoded_data = full_runs.tobytes()
+    if tail_length > 0:
+        encoded_data += bytes([tail_length - 1]) + data[num_of_full_runs * 32:].tobytes()
+    return encoded_data
+
+
+# Field dtype kind -> PCD type, and field dtype -> PLY property type
+PCD_FIELD_TYPES = {"f": "F", "u": "U", "i": "I"}
+PLY_PROPERTY_TYPES = {
+    "<f4": "float", "<f8": "double",
+    "|u1": "uchar", "<u2": "ushort", "<u4": "uint",
+    "|i1": "char", "<i2": "short", "<i4": "int"
+}
+
+
+class PointCloudWriter:
+    def __init__(self, filepath: str, data_format: str = "binary"):
+        """
+        Write a point cloud straight from a NumPy points array (and optional per-point scalar fields).
+        Supported formats are pcd (ascii, binary and binary_compressed) and ply (ascii and binary little endian).
+        :param filepath: The output file path (the format is set by its suffix).
+        :param data_format: The data format of the file.
+        """
+        self.filepath = filepath
+        self.file_type = pathlib.Path(filepath).suffix.lower().lstrip(".")
+        self.data_format = data_format
+        if self.file_type == "pcd":
+            if data_format not in PCD_DATA_FORMATS:
+                raise ValueError(f"Invalid pcd data format: {data_format}")
+            if data_format == "binary_compressed" and lzf is None:
+                raise ImportError("The binary_compressed data format requires the lzf package (pip install python-lzf)")
+        elif self.file_type == "ply":
+            if data_format not in PLY_DATA_FORMATS:
+                raise ValueError(f"Invalid ply data format: {data_format}")
+        else:
+            raise ValueError(f"Unsupported point cloud format: {self.file_type}")
+
+    @staticmethod
+    def get_point_records(points: np.ndarray, fields: Optional[Dict[str, np.ndarray]] = None) -> np.ndarray:
+        """
+        Pack the points and the extra fields into little endian point records (x, y, z, *fields).
+        """
+        points = np.asarray(points).reshape(-1, 3)
+        fields = fields if fields is not None else {}
+        record_dtype = [("x", "<f4"), ("y", "<f4"), ("z", "<f4")]
+        for field_name, field_values in fields.items():
+            field_dtype = np.asarray(field_values).dtype.newbyteorder("<")
+            if field_dtype.str not in PLY_PROPERTY_TYPES:
+                raise ValueError(f"Unsupported point field type: {field_name} ({field_dtype})")
+            record_dtype.append((field_name, field_dtype))
+
+        point_records = np.empty(shape=len(points), dtype=record_dtype)
+        point_records["x"] = points[:, 0]
+        point_records["y"] = points[:, 1]
+        point_records["z"] = points[:, 2]
+        for field_name, field_values in fields.items():
+            point_records[field_name] = field_values
+        return point_records
+
+    @staticmethod
+    def get_ascii_data(point_records: np.ndarray) -> bytes:
+        record_format = " ".join(
+            "%.8f" if point_records.dtype[field_name].kind == "f" else "%d"
+            for field_name in point_records.dtype.names
+        )
+        flat_values = [value for record in point_records.tolist() for value in record]
+        return (((record_format + "\n") * len(point_records)) % tuple(flat_values)).encode("ascii")
+
+    def write(self, points: np.ndarray, fields: Optional[Dict[str, np.ndarray]] = None, fp: Optional[BinaryIO] = None):
+        """
+        :param points: The (N, 3) points.
+        :param fields: A dictionary of field name -> (N,) values of the extra per-point fields (e.g. labels).
+        :param fp: A binary file object to write to (instead of the output file path, e.g. an in-memory file).
+        """
+        if fp is None:
+            with open(self.filepath, "wb") as fp:
+                return self.write(points=points, fields=fields, fp=fp)
+
+        point_records = self.get_point_records(points=points, fields=fields)
+        if self.file_type == "pcd":
+            self.write_pcd(point_records=point_records, fp=fp)
+        else:
+            self.write_ply(point_records=point_records, fp=fp)
+
+    def write_pcd(self, point_records: np.ndarray, fp: BinaryIO):
+        field_names = point_records.dtype.names
+        field_dtypes = [point_records.dtype[field_name] for field_name in field_names]
+        header = (
+            "# .PCD v0.7 - Point Cloud Data file format\n"
+            "VERSION 0.7\n"
+            f"FIELDS {' '.join(field_names)}\n"
+            f"SIZE {' '.join(str(field_dtype.itemsize) for field_dtype in field_dtypes)}\n"
+            f"TYPE {' '.join(PCD_FIELD_TYPES[field_dtype.kind] for field_dtype in field_dtypes)}\n"
+            f"COUNT {' '.join('1' for _ in field_names)}\n"
+            f"WIDTH {len(point_records)}\n"
+            "HEIGHT 1\n"
+            "VIEWPOINT 0 0 0 1 0 0 0\n"
+            f"POINTS {len(point_records)}\n"
+            f"DATA {self.data_format}\n"
+        )
+
+        fp.write(header.encode("ascii"))
+        if self.data_format == "ascii":
+            fp.write(self.get_ascii_data(point_records=point_records))
+        elif self.data_format == "binary":
+            fp.write(point_records.tobytes())
+        else:
+            # Notice: The compressed data is stored field by field (all the x values, then all the y values, ...)
+            uncompressed_data = b"".join(
+                np.ascontiguousarray(point_records[field_name]).tobytes() for field_name in field_names
+            )
+            compressed_data = lzf_compress(data=uncompressed_data)
+            fp.write(np.array([len(compressed_data), len(uncompressed_data)], dtype="<u4").tobytes())
+            fp.write(compressed_data)
+
+    def write_ply(self, point_records: np.ndarray, fp: BinaryIO):
+        ply_format = "ascii" if self.data_format == "ascii" else "binary_little_endian"
+        header = (
+            "ply\n"
+            f"format {ply_format} 1.0\n"
+            f"element vertex {len(point_records)}\n"
+            + "".join(
+                f"property {PLY_PROPERTY_TYPES[point_records.dtype[field_name].str]} {field_name}\n"
+                for field_name in point_records.dtype.names
+            )
+            + "end_header\n"
+        )
+
+        fp.write(header.encode("ascii"))
+        if self.data_format == "ascii":
+            fp.write(self.get_ascii_data(point_records=point_records))
+        else:
+            fp.write(point_records.tobytes())
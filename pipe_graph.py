@@ -0,0 +1,169 @@
+import json
+import numpy as np
+from typing import List, Optional, Tuple
+
+
+# Connection type -> bit index in the 6-bit connection masks (the opposite connection type is at bit ^ 1)
+CONNECTION_TYPES = ["x", "-x", "y", "-y", "z", "-z"]
+CONNECTION_TYPE_BITS = {connection_type: 1 << bit for bit, connection_type in enumerate(CONNECTION_TYPES)}
+CONNECTION_TYPE_DELTAS = np.array([
+    [1, 0, 0],
+    [-1, 0, 0],
+    [0, 1, 0],
+    [0, -1, 0],
+    [0, 0, 1],
+    [0, 0, -1]
+], dtype=np.int32)
+ALL_CONNECTIONS_MASK = (1 << len(CONNECTION_TYPES)) - 1
+
+# Positions are packed into int64 keys (21 bits per axis), so the coordinates must be within +-2^20
+POSITION_KEY_BITS = 21
+POSITION_KEY_OFFSET = 1 << (POSITION_KEY_BITS - 1)
+
+
+def connections_to_mask(connections: List[str]) -> int:
+    mask = 0
+    for connection_type in connections:
+        if connection_type not in CONNECTION_TYPE_BITS:
+            raise ValueError(f"Invalid connection type: {connection_type}")
+        mask |= CONNECTION_TYPE_BITS[connection_type]
+    return mask
+
+
+def mask_to_connections(mask: int) -> List[str]:
+    return [connection_type for bit, connection_type in enumerate(CONNECTION_TYPES) if mask & (1 << bit)]
+
+
+def get_position_keys(positions: np.ndarray) -> np.ndarray:
+    """
+    Pack (..., 3) integer positions into (...,) sortable int64 keys.
+    """
+    positions = np.asarray(positions, dtype=np.int64) + POSITION_KEY_OFFSET
+    return (positions[..., 0] << (2 * POSITION_KEY_BITS)) | (positions[..., 1] << POSITION_KEY_BITS) | positions[..., 2]
+
+
+def lookup_position_keys(sorted_keys: np.ndarray, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find keys in a sorted keys array.
+    :return: The indices of the keys in the sorted keys, and whether each key was found.
+    """
+    if len(sorted_keys) == 0:
+        return np.zeros(shape=keys.shape, dtype=np.int64), np.zeros(shape=keys.shape, dtype=bool)
+    indices = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return indices, sorted_keys[indices] == keys
+
+
+class PipeGraph:
+    def __init__(self, positions: np.ndarray, opened_masks: np.ndarray, node_ids: Optional[list] = None):
+        """
+        A compact pipes graph: an int32 position and a uint8 opened connections mask per node.
+        The closed connections of a node are all the connections that are not opened.
+        :param positions: The (N, 3) node positions.
+        :param opened_masks: The (N,) opened connections masks (bit i is CONNECTION_TYPES[i]).
+        :param node_ids: The node ids (None for the node indices as strings).
+        """
+        self.positions = np.ascontiguousarray(positions, dtype=np.int32).reshape(-1, 3)
+        self.opened_masks = np.ascontiguousarray(opened_masks, dtype=np.uint8).reshape(-1)
+        if len(self.positions) != len(self.opened_masks):
+            raise ValueError("The number of positions and opened masks must be equal")
+        self.node_ids = node_ids
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def get_node_ids(self) -> list:
+        if self.node_ids is not None:
+            return list(self.node_ids)
+        return [str(node_idx) for node_idx in range(len(self))]
+
+    def get_csr(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Derive the adjacency on demand, as CSR arrays: an edge for each opened connection that leads to an existing
+        node. The neighbors are found by hashing all the neighbor coordinates at once (sorted int64 position keys).
+        :return: The (N + 1,) index pointers and the neighbor node indices (the neighbors of node i are
+        indices[indptr[i]:indptr[i + 1]], in ascending order).
+        """
+        num_of_nodes = len(self)
+        if num_of_nodes == 0:
+            return np.zeros(shape=1, dtype=np.int64), np.empty(shape=0, dtype=np.int64)
+
+        # Notice: The positions are shifted to the origin, so any graph within 2^21 per axis fits in the keys
+        positions = self.positions.astype(np.int64) - self.positions.min(axis=0) - POSITION_KEY_OFFSET + 1
+        if positions.max() >= POSITION_KEY_OFFSET - 1:
+            raise ValueError("The graph is too large for the position keys")
+        node_keys = get_position_keys(positions=positions)
+        node_order = np.argsort(node_keys, kind="stable")
+        sorted_keys = node_keys[node_order]
+
+        node_indices, bits = np.nonzero((self.opened_masks[:, np.newaxis] >> np.arange(len(CONNECTION_TYPES))) & 1)
+        neighbor_keys = get_position_keys(positions=positions[node_indices] + CONNECTION_TYPE_DELTAS[bits])
+        lookup_indices, is_found = lookup_position_keys(sorted_keys=sorted_keys, keys=neighbor_keys)
+        sources = node_indices[is_found]
+        targets = node_order[lookup_indices[is_found]]
+
+        # Symmetrize, and remove the duplicates (an edge opened on both sides) and the self loops
+        pairs = np.sort(np.concatenate([sources * num_of_nodes + targets, targets * num_of_nodes + sources]))
+        pairs = pairs[np.diff(pairs, prepend=-1) != 0]
+        sources, targets = np.divmod(pairs, num_of_nodes)
+        not_self_loops = sources != targets
+        sources, targets = sources[not_self_loops], targets[not_self_loops]
+
+        indptr = np.zeros(shape=num_of_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=num_of_nodes), out=indptr[1:])
+        return indptr, targets
+
+    def get_edges(self) -> np.ndarray:
+        """
+        :return: The (E, 2) node index pairs (each edge once, smaller index first).
+        """
+        indptr, indices = self.get_csr()
+        sources = np.repeat(np.arange(len(self), dtype=np.int64), np.diff(indptr))
+        upper = sources < indices
+        return np.stack([sources[upper], indices[upper]], axis=1).reshape(-1, 2)
+
+    #################
+    # Compatibility #
+    #################
+    @classmethod
+    def from_nodes_data(cls, nodes_data: dict):
+        node_ids = list(nodes_data.keys())
+        positions = np.array([node_data["position"] for node_data in nodes_data.values()], dtype=np.int32)
+        opened_masks = np.array(
+            [connections_to_mask(node_data["opened_connection_list"]) for node_data in nodes_data.values()],
+            dtype=np.uint8
+        )
+        return cls(positions=positions, opened_masks=opened_masks, node_ids=node_ids)
+
+    def to_nodes_data(self) -> dict:
+        """
+        The json view of the graph (see the JSON Graph Format in the README).
+        """
+        nodes_data = {}
+        node_ids = self.get_node_ids()
+        for node_id, position, opened_mask in zip(node_ids, self.positions.tolist(), self.opened_masks.tolist()):
+            nodes_data[node_id] = {
+                "position": position,
+                "opened_connection_list": mask_to_connections(opened_mask),
+                "closed_connection_list": mask_to_connections(ALL_CONNECTIONS_MASK & ~opened_mask)
+            }
+        return nodes_data
+
+    def to_json(self) -> str:
+        return json.dumps(obj=self.to_nodes_data(), indent=4)
+
+    def save_json(self, filepath: str):
+        with open(filepath, "w") as fp:
+            fp.write(self.to_json())
+
+    def to_networkx(self):
+        """
+        The networkx view of the graph (nodes with "position" and "connections" attributes).
+        """
+        import networkx as nx
+
+        node_ids = self.get_node_ids()
+        graph = nx.Graph()
+        for node_id, position, opened_mask in zip(node_ids, self.positions.tolist(), self.opened_masks.tolist()):
+            graph.add_node(node_id, position=tuple(position), connections=mask_to_connections(opened_mask))
+        graph.add_edges_from((node_ids[node_i], node_ids[node_j]) for node_i, node_j in self.get_edges().tolist())
+        return graph
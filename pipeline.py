@@ -0,0 +1,130 @@
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator, List
+
+
+# Notice: Marks the end of the items of a stage queue (one per worker of the consuming stage)
+END_OF_ITEMS = object()
+
+
+class PipelineStage:
+    def __init__(self, name: str, function: Callable[[Any], Any], num_of_workers: int = 1):
+        """
+        A pipeline stage: its worker threads apply the function to each item, and pass the result to the next stage.
+        :param name: The stage name (used in the error messages).
+        :param function: The item -> next item function (called concurrently by the stage workers).
+        :param num_of_workers: The number of worker threads of the stage.
+        """
+        if num_of_workers < 1:
+            raise ValueError(f"The {name} stage requires at least 1 worker")
+        self.name = name
+        self.function = function
+        self.num_of_workers = num_of_workers
+
+
+class Pipeline:
+    def __init__(self, stages: List[PipelineStage], queue_size: int = 2):
+        """
+        Run items through a chain of stages that work concurrently (e.g. compute stages and a disk writer stage).
+        The stages are connected by bounded queues, so a slow stage blocks the stages before it (backpressure),
+        and the number of items held in memory is capped.
+        :param stages: The stages, in order.
+        :param queue_size: The max number of items waiting in each queue between two stages.
+        """
+        if len(stages) == 0:
+            raise ValueError("The pipeline requires at least 1 stage")
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def run(self, items: Iterable) -> Iterator:
+        """
+        :param items: The input items of the first stage.
+        :return: The results of the last stage, in completion order (not in input order).
+        The first stage error stops the pipeline and is raised.
+        """
+        stop_event = threading.Event()
+        errors = []
+        stage_queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+
+        def put(item_queue: queue.Queue, item) -> bool:
+            # Notice: Puts wait with a timeout, so blocked producers notice a stop of the pipeline
+            while not stop_event.is_set():
+                try:
+                    item_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(item_queue: queue.Queue):
+            while not stop_event.is_set():
+                try:
+                    return item_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return END_OF_ITEMS
+
+        def stop(error: BaseException):
+            errors.append(error)
+            stop_event.set()
+
+        def feed():
+            try:
+                for item in items:
+                    if not put(stage_queues[0], item):
+                        return
+                for _ in range(self.stages[0].num_of_workers):
+                    put(stage_queues[0], END_OF_ITEMS)
+            except BaseException as error:
+                stop(error)
+
+        # The last worker of a stage to finish signals the end of the items to the next stage
+        num_of_running_workers = [stage.num_of_workers for stage in self.stages]
+        running_workers_lock = threading.Lock()
+
+        def work(stage_idx: int):
+            stage = self.stages[stage_idx]
+            next_num_of_workers = self.stages[stage_idx + 1].num_of_workers if stage_idx + 1 < len(self.stages) else 1
+            try:
+                while True:
+                    item = get(stage_queues[stage_idx])
+                    if item is END_OF_ITEMS:
+                        break
+                    if not put(stage_queues[stage_idx + 1], stage.function(item)):
+                        break
+            except BaseException as error:
+                stage_error = RuntimeError(f"The {stage.name} stage failed: {error!r}")
+                stage_error.__cause__ = error
+                stop(stage_error)
+                return
+
+            with running_workers_lock:
+                num_of_running_workers[stage_idx] -= 1
+                is_last_worker = num_of_running_workers[stage_idx] == 0
+            if is_last_worker:
+                for _ in range(next_num_of_workers):
+                    put(stage_queues[stage_idx + 1], END_OF_ITEMS)
+
+        threads = [threading.Thread(target=feed, daemon=True)]
+        for stage_idx, stage in enumerate(self.stages):
+            threads.extend(
+                threading.Thread(target=work, args=(stage_idx,), name=f"{stage.name}-{worker_idx}", daemon=True)
+                for worker_idx in range(stage.num_of_workers)
+            )
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                result = get(stage_queues[-1])
+                if result is END_OF_ITEMS:
+                    break
+                yield result
+        finally:
+            # Notice: Stop the workers if the results are no longer consumed (e.g. the caller failed)
+            stop_event.set()
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
@@ -0,0 +1,180 @@
+import functools
+import os
+import numpy as np
+import trimesh
+from typing import Union, Tuple, Optional, BinaryIO
+
+from part_kit import write_array_pack, read_array_pack
+from pipe_graph import PipeGraph
+from mesh_builder import MeshBuilder
+
+
+# Notice: Bump the version when the procedural file layout changes
+PROCEDURAL_GRAPH_VERSION = 1
+PROCEDURAL_GRAPH_TYPE = "procedural_graph"
+PROCEDURAL_GRAPH_SUFFIX = ".pf3d"
+
+
+def save_procedural_graph(filepath: str,
+                          pipe_graph: PipeGraph,
+                          mb: MeshBuilder,
+                          pcd_use_sample_method: bool = True,
+                          pcd_points_to_sample: Union[float, int] = 1.0,
+                          seed: Optional[int] = None,
+                          fp: Optional[BinaryIO] = None):
+    """
+    Save a pipes model as its graph and a reference to the kit, instead of its mesh and point cloud files.
+    The mesh is fully determined by the graph, the kit and the mesh scales, and the point cloud also by the seed.
+    :param filepath: The output file path.
+    :param pipe_graph: The graph of the pipes model.
+    :param mb: The mesh builder of the kit (the kit content hash, the hash of each kit file and the mesh scales are
+    stored).
+    :param pcd_use_sample_method: The point cloud parameters (to rebuild the same point cloud).
+    :param pcd_points_to_sample:
+    :param seed: The seed of the point cloud sampling.
+    :param fp: An empty binary file object to write to (instead of the output file path, e.g. an in-memory file).
+    """
+    header = {
+        "type": PROCEDURAL_GRAPH_TYPE,
+        "version": PROCEDURAL_GRAPH_VERSION,
+        "kit_hash": mb.part_kit.kit_hash,
+        "kit_file_hashes": mb.kit_file_hashes,
+        "mesh_dir": mb.mesh_dir,
+        "mesh_scale": mb.mesh_scale,
+        "mesh_apply_scale": mb.mesh_apply_scale,
+        "pcd_use_sample_method": pcd_use_sample_method,
+        "pcd_points_to_sample": pcd_points_to_sample,
+        "seed": seed,
+        "node_ids": pipe_graph.node_ids
+    }
+    arrays = {
+        "positions": pipe_graph.positions,
+        "opened_masks": pipe_graph.opened_masks
+    }
+    write_array_pack(filepath=filepath, header=header, arrays=arrays, fp=fp)
+
+
+def load_procedural_graph(filepath: str) -> Tuple[PipeGraph, dict]:
+    """
+    :return: The graph of the pipes model and the procedural header (kit hash, mesh scales and point cloud parameters).
+    """
+    header, arrays = read_array_pack(filepath=filepath)
+    if header.get("type") != PROCEDURAL_GRAPH_TYPE:
+        raise ValueError(f"Invalid procedural graph file: {filepath}")
+    if header.get("version") != PROCEDURAL_GRAPH_VERSION:
+        raise ValueError(f"Unsupported procedural graph version: {header.get('version')}")
+
+    # Notice: Copy the arrays out of the mapped pages, so the file is not kept open
+    pipe_graph = PipeGraph(
+        positions=np.array(arrays["positions"]),
+        opened_masks=np.array(arrays["opened_masks"]),
+        node_ids=header["node_ids"]
+    )
+    return pipe_graph, header
+
+
+class ProceduralGraphLoader:
+    def __init__(self, mesh_dir: Optional[str] = None, cache_size: int = 32):
+        """
+        Rebuild the meshes and point clouds of procedural graph files on demand.
+        The rebuilt meshes and point clouds are kept in an in-process LRU cache, and a mesh builder is kept per kit
+        and mesh scales.
+        :param mesh_dir: The kit directory (None for the kit directory stored in each file).
+        :param cache_size: The max number of cached meshes (and of cached point clouds).
+        """
+        self.mesh_dir = mesh_dir
+        self.mesh_builders = {}
+        self.cached_build_mesh = functools.lru_cache(maxsize=cache_size)(self.build_mesh)
+        self.cached_build_pcd = functools.lru_cache(maxsize=cache_size)(self.build_pcd)
+
+    def get_mesh_builder(self, header: dict) -> MeshBuilder:
+        mesh_dir = self.mesh_dir if self.mesh_dir is not None else header["mesh_dir"]
+        key = (mesh_dir, header["mesh_scale"], header["mesh_apply_scale"])
+        if key not in self.mesh_builders:
+            self.mesh_builders[key] = MeshBuilder(
+                mesh_dir=mesh_dir,
+                mesh_scale=header["mesh_scale"],
+                mesh_apply_scale=header["mesh_apply_scale"]
+            )
+
+        mb = self.mesh_builders[key]
+        if mb.part_kit.kit_hash != header["kit_hash"]:
+            raise ValueError(self.get_kit_mismatch_message(mb=mb, header=header))
+        return mb
+
+    @staticmethod
+    def get_kit_mismatch_message(mb: MeshBuilder, header: dict) -> str:
+        # Notice: The kit hash is a content hash of the OBJ files, so a mismatch means that the OBJ files differ
+        message = f"The OBJ files of the kit in {mb.mesh_dir} differ from the kit of the procedural graph file"
+        if "kit_file_hashes" not in header:
+            return message
+        different_filenames = [
+            filename for filename, file_hash in mb.kit_file_hashes.items()
+            if header["kit_file_hashes"].get(filename) != file_hash
+        ]
+        return f"{message} (different files: {', '.join(different_filenames)})"
+
+    @staticmethod
+    def get_file_key(filepath: str) -> Tuple[str, int]:
+        # Notice: The modification time is part of the cache key, so rewritten files are rebuilt
+        filepath = os.path.abspath(filepath)
+        return filepath, os.stat(filepath).st_mtime_ns
+
+    def build_mesh(self, filepath: str, mtime_ns: int) -> trimesh.Trimesh:
+        pipe_graph, header = load_procedural_graph(filepath=filepath)
+        mb = self.get_mesh_builder(header=header)
+        positions, masks, _ = mb.get_pipe_graph_arrays(pipe_graph=pipe_graph)
+        return mb.assemble_mesh(positions=positions, masks=masks)
+
+    def build_pcd(self,
+                  filepath: str,
+                  mtime_ns: int,
+                  points_to_sample: Union[float, int, None],
+                  seed: Optional[int]) -> np.ndarray:
+        pipe_graph, header = load_procedural_graph(filepath=filepath)
+        mb = self.get_mesh_builder(header=header)
+        points = mb.build_pcd(
+            input_object=pipe_graph,
+            use_sample_method=header["pcd_use_sample_method"],
+            points_to_sample=points_to_sample if points_to_sample is not None else header["pcd_points_to_sample"],
+            output_only=True,
+            seed=seed if seed is not None else header["seed"]
+        )
+        points.setflags(write=False)
+        return points
+
+    def load_mesh(self, filepath: str) -> trimesh.Trimesh:
+        """
+        Rebuild (or get the cached) mesh of a procedural graph file.
+        Notice: The cached mesh is shared by the callers, copy it before modifying it.
+        """
+        return self.cached_build_mesh(*self.get_file_key(filepath=filepath))
+
+    def load_pcd(self,
+                 filepath: str,
+                 points_to_sample: Union[float, int, None] = None,
+                 seed: Optional[int] = None) -> np.ndarray:
+        """
+        Rebuild (or get the cached) point cloud of a procedural graph file.
+        By default, the point cloud parameters and seed stored in the file are used (the same point cloud as generated).
+        :return: The (N, 3) read-only points.
+        """
+        return self.cached_build_pcd(*self.get_file_key(filepath=filepath), points_to_sample, seed)
+
+    def clear_cache(self):
+        self.cached_build_mesh.cache_clear()
+        self.cached_build_pcd.cache_clear()
+
+
+def main():
+    # Procedural Graph Parameters
+    filepath = "output/01.pf3d"
+
+    loader = ProceduralGraphLoader()
+    mesh = loader.load_mesh(filepath=filepath)
+    points = loader.load_pcd(filepath=filepath)
+    print(f"Mesh: {len(mesh.vertices)} vertices, {len(mesh.faces)} faces | Point cloud: {len(points)} points")
+
+
+if __name__ == '__main__':
+    main()
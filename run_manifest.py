@@ -0,0 +1,225 @@
+import contextlib
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Iterator, List, Optional
+
+from dataset_archive import ArchiveReader
+
+
+RUN_MANIFEST_FILENAME = "manifest.jsonl"
+RUN_INDEX_FILENAME = "index.jsonl"
+
+
+def get_run_manifest_filename(shard_index: int = 0, num_of_shards: int = 1) -> str:
+    """
+    :return: The manifest filename of a run shard (each shard of a sharded run writes its own manifest).
+    """
+    if num_of_shards == 1:
+        return RUN_MANIFEST_FILENAME
+    return f"manifest-{shard_index:05d}-of-{num_of_shards:05d}.jsonl"
+
+
+def get_shard_indices(num_of_outputs: int, shard_index: int = 0, num_of_shards: int = 1) -> List[int]:
+    """
+    :return: The output indices of a run shard (the outputs are dealt round-robin to the shards).
+    """
+    if not 0 <= shard_index < num_of_shards:
+        raise ValueError(f"Invalid shard index: {shard_index} (of {num_of_shards} shards)")
+    return list(range(shard_index, num_of_outputs, num_of_shards))
+
+
+def get_data_checksum(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def get_file_checksum(filepath: str, block_size: int = 1 << 20) -> str:
+    """
+    :return: The sha256 hex digest of the file.
+    """
+    sha256 = hashlib.sha256()
+    with open(filepath, "rb") as fp:
+        for block in iter(lambda: fp.read(block_size), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+@contextlib.contextmanager
+def atomic_output_file(filepath: str) -> Iterator[str]:
+    """
+    Write a file atomically: the caller writes to the yielded temporary path (in the same directory, with the same
+    suffix), which replaces the file only if the write succeeds. A crash never leaves a partially written file.
+    """
+    dirname, basename = os.path.split(filepath)
+    tmp_filepath = os.path.join(dirname, f".tmp-{os.getpid()}-{threading.get_ident()}-{basename}")
+    try:
+        yield tmp_filepath
+        os.replace(tmp_filepath, filepath)
+    finally:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+
+
+def is_output_file_intact(output_dir: str,
+                          record: dict,
+                          filename: str,
+                          checksum: Optional[str] = None,
+                          archive_reader: Optional[ArchiveReader] = None) -> bool:
+    """
+    Check that an output file exists (as a file, or as a member of the archive shards for archived outputs),
+    and that it matches the checksum (if given).
+    """
+    if "archive" in record:
+        if archive_reader is None or not archive_reader.has_member(name=filename):
+            return False
+        return checksum is None or get_data_checksum(data=archive_reader.read_member(name=filename)) == checksum
+
+    filepath = os.path.join(output_dir, filename)
+    if not os.path.isfile(filepath):
+        return False
+    return checksum is None or get_file_checksum(filepath=filepath) == checksum
+
+
+class RunManifest:
+    def __init__(self, filepath: str):
+        """
+        A JSON lines record of the completed outputs of a run: the index, seed and generation parameters of each
+        output, and the sha256 checksum of each of its files.
+        Records are only appended, so a run that dies leaves a valid manifest (a truncated last line is ignored).
+        :param filepath: The manifest file path.
+        """
+        self.filepath = filepath
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_record(idx: int, seed: int, params: dict, file_checksums: Dict[str, str]) -> dict:
+        """
+        :param file_checksums: The filename (relative to the manifest directory) -> checksum of the output files.
+        When the files are archived, the archive shard filename is added to the record (as "archive").
+        """
+        return {"idx": idx, "seed": seed, "params": params, "files": file_checksums}
+
+    def load(self) -> Dict[int, dict]:
+        """
+        :return: The latest record of each output index.
+        """
+        records = {}
+        if not os.path.exists(self.filepath):
+            return records
+        with open(self.filepath, "r") as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                records[record["idx"]] = record
+        return records
+
+    def reset(self):
+        with self.lock:
+            with open(self.filepath, "w"):
+                pass
+
+    def append(self, record: dict):
+        # Notice: Each record is a single flushed line, so the records of a dead run are kept
+        with self.lock:
+            with open(self.filepath, "a") as fp:
+                fp.write(json.dumps(record, separators=(",", ":")) + "\n")
+                fp.flush()
+                os.fsync(fp.fileno())
+
+    def is_verified(self, record: Optional[dict], params: dict, archive_reader: Optional[ArchiveReader] = None) -> bool:
+        """
+        Check that an output was generated with the given parameters, and that all its files are intact.
+        :param archive_reader: The reader of the archive shards (for the outputs of archived runs).
+        """
+        if record is None or record["params"] != params:
+            return False
+        for filename, checksum in record["files"].items():
+            if not is_output_file_intact(output_dir=os.path.dirname(self.filepath), record=record, filename=filename,
+                                         checksum=checksum, archive_reader=archive_reader):
+                return False
+        return True
+
+    def write(self, records: List[dict]):
+        # Notice: The manifest is rewritten atomically
+        with self.lock:
+            with atomic_output_file(filepath=self.filepath) as tmp_filepath:
+                with open(tmp_filepath, "w") as fp:
+                    fp.writelines(json.dumps(record, separators=(",", ":")) + "\n" for record in records)
+
+    def get_pending_indices(self,
+                            indices: List[int],
+                            params: dict,
+                            archive_reader: Optional[ArchiveReader] = None) -> List[int]:
+        """
+        Verify the recorded outputs, and keep only the records of the verified outputs in the manifest
+        (this also drops a truncated last line of a dead run).
+        :param indices: The output indices of the run.
+        :param params: The generation parameters of the run.
+        :param archive_reader: The reader of the archive shards (for the outputs of archived runs).
+        :return: The indices of the outputs that are missing, corrupt, or were generated with other parameters.
+        """
+        records = self.load()
+        verified_records = []
+        pending_indices = []
+        for idx in indices:
+            if self.is_verified(record=records.get(idx), params=params, archive_reader=archive_reader):
+                verified_records.append(records[idx])
+            else:
+                pending_indices.append(idx)
+        self.write(records=verified_records)
+        return pending_indices
+
+    def get_master_seed(self) -> Optional[int]:
+        """
+        :return: The master seed of the recorded outputs (None if there are none).
+        """
+        for record in self.load().values():
+            return record["params"].get("master_seed")
+        return None
+
+
+def merge_run_manifests(output_dir: str, num_of_outputs: int, num_of_shards: int, verify: bool = False) -> str:
+    """
+    Merge the manifests of the shards of a sharded run into a global index of the run (a manifest of all the outputs,
+    sorted by index, with the shard of each output).
+    :param output_dir: The shared output directory of the shards.
+    :param num_of_outputs: The total number of outputs of the run.
+    :param num_of_shards: The number of shards of the run.
+    :param verify: Also verify the checksums of all the output files (otherwise only their existence is checked).
+    The files of archived outputs are checked in the archive shards of the output directory.
+    :return: The global index file path.
+    """
+    index_records = {}
+    params = None
+    archive_reader = ArchiveReader(archive_dir=output_dir)
+    for shard_index in range(num_of_shards):
+        manifest_filepath = os.path.join(output_dir, get_run_manifest_filename(shard_index, num_of_shards))
+        if not os.path.exists(manifest_filepath):
+            raise ValueError(f"Missing shard manifest: {manifest_filepath}")
+
+        for idx, record in RunManifest(filepath=manifest_filepath).load().items():
+            if idx % num_of_shards != shard_index or idx >= num_of_outputs:
+                raise ValueError(f"Output {idx} doesn't belong to shard {shard_index}")
+            if params is None:
+                params = record["params"]
+            elif record["params"] != params:
+                raise ValueError(f"Output {idx} was generated with other parameters than the rest of the run")
+            for filename, checksum in record["files"].items():
+                if not is_output_file_intact(output_dir=output_dir, record=record, filename=filename,
+                                             checksum=checksum if verify is True else None,
+                                             archive_reader=archive_reader):
+                    raise ValueError(f"Missing or corrupt file of output {idx}: {filename}")
+            index_records[idx] = {**record, "shard": shard_index}
+
+    # Check the coverage: every output of the run is in exactly one shard
+    missing_indices = [idx for idx in range(num_of_outputs) if idx not in index_records]
+    if missing_indices:
+        raise ValueError(f"{len(missing_indices)} missing outputs (the first are {missing_indices[:10]})")
+
+    archive_reader.close()
+    index_filepath = os.path.join(output_dir, RUN_INDEX_FILENAME)
+    RunManifest(filepath=index_filepath).write(records=[index_records[idx] for idx in range(num_of_outputs)])
+    return index_filepath
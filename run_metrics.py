@@ -0,0 +1,280 @@
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+from typing import Dict, Iterator, List, Optional
+import numpy as np
+
+
+SUMMARY_PERCENTILES = [50, 90, 99]
+
+# The interval (in seconds) of the RSS samples of the memory tracking
+RSS_SAMPLE_INTERVAL = 0.01
+
+
+def get_current_rss() -> Optional[int]:
+    """
+    :return: The current resident set size (in bytes) of the process (None where /proc is not available).
+    """
+    try:
+        with open("/proc/self/statm", "r") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class RssSampler:
+    def __init__(self, interval: float = RSS_SAMPLE_INTERVAL):
+        """
+        Sample the RSS of the process in a background thread, and keep the peak since the last take_peak.
+        Unlike the tracemalloc peaks, the RSS includes the native allocations, the allocator slack and the pages of
+        the memory-mapped files.
+        :param interval: The interval (in seconds) between the samples.
+        """
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.peak_rss = get_current_rss()
+        self.is_available = self.peak_rss is not None
+        if self.is_available:
+            threading.Thread(target=self.sample, name="rss-sampler", daemon=True).start()
+
+    def sample(self):
+        while True:
+            time.sleep(self.interval)
+            self.update()
+
+    def update(self):
+        current_rss = get_current_rss()
+        with self.lock:
+            if current_rss is not None and (self.peak_rss is None or current_rss > self.peak_rss):
+                self.peak_rss = current_rss
+
+    def take_peak(self) -> Optional[int]:
+        """
+        :return: The peak RSS (in bytes) since the last call (None where the RSS is not available).
+        """
+        if not self.is_available:
+            return None
+        self.update()
+        with self.lock:
+            peak_rss, self.peak_rss = self.peak_rss, get_current_rss()
+        return peak_rss
+
+
+# Per-process RSS sampler (started by the first output that tracks its memory)
+rss_sampler_state = {}
+
+
+def get_rss_sampler() -> RssSampler:
+    if "rss_sampler" not in rss_sampler_state:
+        rss_sampler_state["rss_sampler"] = RssSampler()
+    return rss_sampler_state["rss_sampler"]
+
+
+class OutputMetrics:
+    def __init__(self, idx: int, profile: bool = False, track_memory: bool = False):
+        """
+        The per-stage timings and the counts (nodes, vertices, faces, points) of a single output.
+        :param idx: The output index.
+        :param profile: Profile the stages of the output with cProfile (see finish).
+        :param track_memory: Track the peak memory of each stage: the tracemalloc peak (the Python and numpy
+        allocations, above the traced memory at the start of the output) and the sampled peak RSS of the process.
+        Notice: tracemalloc slows down the allocations, and its peaks are per process (one output at a time).
+        """
+        self.idx = idx
+        self.stage_seconds = {}
+        self.counts = {}
+        self.profiler = cProfile.Profile() if profile is True else None
+
+        # The predicted memory and the memory route of the output (see MeshBuilder.predict_memory)
+        self.predicted_memory = None
+        self.memory_route = None
+        self.stage_peak_memory = None
+        self.stage_peak_rss = None
+        if track_memory is True:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self.traced_memory_start = tracemalloc.get_traced_memory()[0]
+            self.rss_sampler = get_rss_sampler()
+            self.stage_peak_memory = {}
+            self.stage_peak_rss = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Time a stage of the output (the times of a repeated stage are summed).
+        """
+        if self.stage_peak_memory is not None:
+            tracemalloc.reset_peak()
+            self.rss_sampler.take_peak()
+        if self.profiler is not None:
+            self.profiler.enable()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + time.perf_counter() - start_time
+            if self.profiler is not None:
+                self.profiler.disable()
+            if self.stage_peak_memory is not None:
+                peak_memory = tracemalloc.get_traced_memory()[1] - self.traced_memory_start
+                self.stage_peak_memory[name] = max(self.stage_peak_memory.get(name, 0), peak_memory)
+                peak_rss = self.rss_sampler.take_peak()
+                if peak_rss is not None:
+                    self.stage_peak_rss[name] = max(self.stage_peak_rss.get(name, 0), peak_rss)
+
+    def get_memory_record(self) -> Optional[dict]:
+        if self.predicted_memory is None and self.stage_peak_memory is None:
+            return None
+        memory_record = {"predicted": self.predicted_memory, "route": self.memory_route}
+        if self.stage_peak_memory is not None:
+            memory_record["stages"] = self.stage_peak_memory
+            memory_record["peak"] = max(self.stage_peak_memory.values(), default=0)
+            memory_record["rss_stages"] = self.stage_peak_rss
+            memory_record["peak_rss"] = max(self.stage_peak_rss.values(), default=None)
+        return memory_record
+
+    def finish(self, profile_dir: Optional[str] = None, profile_threshold: Optional[float] = None) -> dict:
+        """
+        :param profile_dir: The directory of the cProfile dumps of the outlier outputs.
+        :param profile_threshold: The total time (in seconds) above which an output is an outlier, and its profile
+        is dumped (as <output index>.prof, readable with pstats or snakeviz).
+        :return: The metrics record of the output (the profiler is released, so the record can be sent anywhere).
+        """
+        record = {
+            "idx": self.idx,
+            "total_seconds": sum(self.stage_seconds.values()),
+            "stages": self.stage_seconds,
+            "counts": self.counts
+        }
+        memory_record = self.get_memory_record()
+        if memory_record is not None:
+            record["memory"] = memory_record
+        if self.profiler is not None:
+            if profile_threshold is not None and record["total_seconds"] > profile_threshold:
+                os.makedirs(name=profile_dir, exist_ok=True)
+                profile_filepath = os.path.join(profile_dir, f"{self.idx}.prof")
+                self.profiler.dump_stats(profile_filepath)
+                record["profile"] = profile_filepath
+            self.profiler = None
+        return record
+
+
+class RunMetrics:
+    def __init__(self, filepath: str):
+        """
+        Collect the metrics records of the outputs of a run into a JSON lines metrics file, and summarize them.
+        :param filepath: The metrics file path (the summary is saved next to it, as <name>_summary.json).
+        """
+        self.filepath = filepath
+        self.summary_filepath = f"{os.path.splitext(filepath)[0]}_summary.json"
+        self.lock = threading.Lock()
+        self.records = []
+        self.start_time = time.perf_counter()
+        with open(self.filepath, "w"):
+            pass
+
+    def append(self, record: dict):
+        with self.lock:
+            self.records.append(record)
+            with open(self.filepath, "a") as fp:
+                fp.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    @staticmethod
+    def get_distribution(values: List[float]) -> Dict[str, float]:
+        values = np.asarray(values, dtype=np.float64)
+        distribution = {"mean": float(values.mean()), "max": float(values.max())}
+        for percentile, value in zip(SUMMARY_PERCENTILES, np.percentile(values, SUMMARY_PERCENTILES)):
+            distribution[f"p{percentile}"] = float(value)
+        return distribution
+
+    def summarize_memory(self) -> dict:
+        """
+        The distributions of the predicted and measured peak memory of the outputs (in MB), of the measured peak per
+        graph node (in KB) and of the measured / predicted peak ratio, and the number of outputs of each memory route.
+        Notice: The refused outputs are only counted in the routes (they are never built).
+        """
+        memory_summary = {"routes": {}}
+        memory_values = {name: [] for name in ["predicted_mb", "peak_mb", "peak_rss_mb", "peak_kb_node", "peak_ratio"]}
+        for record in self.records:
+            memory_record = record.get("memory")
+            if memory_record is None:
+                continue
+            route = memory_record["route"]
+            if route is not None:
+                memory_summary["routes"][route] = memory_summary["routes"].get(route, 0) + 1
+            if route == "refused":
+                continue
+
+            predicted_memory = memory_record["predicted"]
+            if predicted_memory is not None:
+                memory_values["predicted_mb"].append(predicted_memory["peak"] / 2 ** 20)
+            if "peak" in memory_record:
+                peak_memory = memory_record["peak"]
+                memory_values["peak_mb"].append(peak_memory / 2 ** 20)
+                if record["counts"].get("nodes", 0) > 0:
+                    memory_values["peak_kb_node"].append(peak_memory / 2 ** 10 / record["counts"]["nodes"])
+                if predicted_memory is not None and predicted_memory["peak"] > 0:
+                    memory_values["peak_ratio"].append(peak_memory / predicted_memory["peak"])
+                if memory_record["peak_rss"] is not None:
+                    memory_values["peak_rss_mb"].append(memory_record["peak_rss"] / 2 ** 20)
+
+        for name, values in memory_values.items():
+            if len(values) > 0:
+                memory_summary[name] = self.get_distribution(values=values)
+        return memory_summary
+
+    def summarize(self) -> dict:
+        """
+        Save and print the summary of the run: the percentiles of the time of each stage, and the throughput
+        (and the memory distributions, if the memory of the outputs is predicted or tracked).
+        """
+        wall_seconds = time.perf_counter() - self.start_time
+        summary = {"num_of_outputs": len(self.records), "wall_seconds": wall_seconds, "stages": {}, "throughput": {}}
+        if len(self.records) == 0:
+            return summary
+
+        stage_names = list(dict.fromkeys(name for record in self.records for name in record["stages"]))
+        for stage_name in stage_names + ["total"]:
+            stage_values = [
+                record["total_seconds"] if stage_name == "total" else record["stages"][stage_name]
+                for record in self.records
+                if stage_name == "total" or stage_name in record["stages"]
+            ]
+            summary["stages"][stage_name] = self.get_distribution(values=stage_values)
+
+        summary["throughput"]["outputs_per_second"] = len(self.records) / wall_seconds
+        count_names = list(dict.fromkeys(name for record in self.records for name in record["counts"]))
+        for count_name in count_names:
+            total_count = sum(record["counts"].get(count_name, 0) for record in self.records)
+            summary["throughput"][f"{count_name}_per_second"] = total_count / wall_seconds
+        if any("memory" in record for record in self.records):
+            summary["memory"] = self.summarize_memory()
+
+        with open(self.summary_filepath, "w") as fp:
+            json.dump(obj=summary, fp=fp, indent=4)
+
+        header = f"{'stage':>14} | " + " | ".join(
+            f"{name:>9}" for name in ["mean"] + [f"p{percentile}" for percentile in SUMMARY_PERCENTILES] + ["max"]
+        )
+        print(header)
+        for stage_name, distribution in summary["stages"].items():
+            print(f"{stage_name:>14} | " + " | ".join(
+                f"{distribution[name]:>8.3f}s"
+                for name in ["mean"] + [f"p{percentile}" for percentile in SUMMARY_PERCENTILES] + ["max"]
+            ))
+        print(" | ".join(f"{name}: {value:.1f}" for name, value in summary["throughput"].items()))
+        if "memory" in summary:
+            for memory_name, distribution in summary["memory"].items():
+                if memory_name == "routes":
+                    continue
+                print(f"{memory_name:>14} | " + " | ".join(
+                    f"{distribution[name]:>9.2f}"
+                    for name in ["mean"] + [f"p{percentile}" for percentile in SUMMARY_PERCENTILES] + ["max"]
+                ))
+            if len(summary["memory"]["routes"]) > 0:
+                print(" | ".join(f"{route}: {count}" for route, count in summary["memory"]["routes"].items()))
+        return summary